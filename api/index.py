@@ -1,12 +1,30 @@
 import os
+import argparse
+import asyncio
+import atexit
+import base64
+import csv
+import hashlib
+import hmac
+import httpx
+import io
 import json
+import numpy as np
+import random
+import string
 import requests
 import telebot
 import re
-from flask import Flask, request, jsonify
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from flask import Flask, Response, jsonify, request, stream_with_context
 from telebot.types import Update
-from datetime import datetime, timedelta
-from groq import Groq
+from datetime import datetime, timedelta, timezone
+from groq import AsyncGroq, Groq, APIConnectionError, APIStatusError
 
 app = Flask(__name__)
 
@@ -14,11 +32,101 @@ app = Flask(__name__)
 TOKEN = os.environ.get("TELEGRAM_TOKEN", "")
 SUPABASE_URL = os.environ.get("SUPABASE_URL", "")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "")
+# service_role key; only it may run the billing RPC (see setup.sql)
+SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY", "")
+# Project JWT secret: signs the per-user tokens the RLS policies check
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET", "")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "")
 DASHBOARD_PASSWORD = os.environ.get("DASHBOARD_PASSWORD", "contabil123")
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "contabil.db")
+# Vercel cron sends "Authorization: Bearer $CRON_SECRET"
+CRON_SECRET = os.environ.get("CRON_SECRET", "")
+# Due charges older than this are skipped (not backfilled) on a billing run
+BILLING_MAX_BACKFILL_DAYS = int(os.environ.get("BILLING_MAX_BACKFILL_DAYS", "31"))
+# Telegram user id the shared dashboard password logs in as
+DASHBOARD_OWNER_ID = int(os.environ.get("DASHBOARD_OWNER_ID", "1"))
+# Key for per-user dashboard tokens issued by the /dashboard command
+DASHBOARD_SECRET = os.environ.get("DASHBOARD_SECRET", TOKEN)
+GROQ_MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+GROQ_FALLBACK_MODEL = os.environ.get("GROQ_FALLBACK_MODEL", "llama-3.1-8b-instant")
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", "20"))
+GROQ_CATEGORIZATION_TIMEOUT = float(os.environ.get("GROQ_CATEGORIZATION_TIMEOUT", "6"))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", "2"))
+GROQ_BREAKER_THRESHOLD = int(os.environ.get("GROQ_BREAKER_THRESHOLD", "5"))
+GROQ_BREAKER_COOLDOWN = float(os.environ.get("GROQ_BREAKER_COOLDOWN", "30"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "600"))
+SNAPSHOT_TTL = float(os.environ.get("SNAPSHOT_TTL", "300"))
+SNAPSHOT_PAGE_SIZE = 1000
+SNAPSHOT_MAX_USERS = int(os.environ.get("SNAPSHOT_MAX_USERS", "64"))
+# Seconds a store-side ledger version probe is reused before asking again
+LEDGER_PROBE_TTL = float(os.environ.get("LEDGER_PROBE_TTL", "2"))
+# Subscription edits leave the ledger counts alone, so other instances'
+# changes are picked up by this TTL instead
+SUBSCRIPTIONS_CACHE_TTL = float(os.environ.get("SUBSCRIPTIONS_CACHE_TTL", "60"))
+TIMESERIES_CACHE_SIZE = int(os.environ.get("TIMESERIES_CACHE_SIZE", "128"))
+# Trigram similarity (0-1) a label needs to match a search; pg_trgm's default
+SEARCH_MIN_SIMILARITY = float(os.environ.get("SEARCH_MIN_SIMILARITY", "0.3"))
+CATEGORY_CACHE_SIZE = 2048
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "200"))
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "1000"))
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "20"))
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "2"))
+HISTORY_MAX_BACKLOG = int(os.environ.get("HISTORY_MAX_BACKLOG", "500"))
+# Tool results fed back to the LLM: rough token cap, and rows kept per list
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("TOOL_RESULT_MAX_TOKENS", "600"))
+TOOL_RESULT_TOP_N = int(os.environ.get("TOOL_RESULT_TOP_N", "20"))
+# "asgi" makes `app` the async ASGI entry point instead of the Flask WSGI app
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "100"))
+# Fractions of the monthly budget that trigger a Telegram alert (once each)
+BUDGET_ALERT_THRESHOLDS = sorted(
+    float(t) for t in os.environ.get("BUDGET_ALERT_THRESHOLDS", "0.8,1").split(",")
+)
+# An expense this many standard deviations above its category mean is flagged
+ANOMALY_Z = float(os.environ.get("ANOMALY_Z", "3"))
+ANOMALY_MIN_SAMPLES = int(os.environ.get("ANOMALY_MIN_SAMPLES", "5"))
 
 bot = telebot.TeleBot(TOKEN, threaded=False)
-groq_client = Groq(api_key=GROQ_API_KEY)
+# Retries are handled by groq_chat() so the SDK's own retry loop is disabled.
+groq_client = Groq(api_key=GROQ_API_KEY, max_retries=0, timeout=GROQ_TIMEOUT)
+
+# Process-wide counters exposed via /api/metrics
+METRICS = {
+    "groq": {
+        "calls": 0,
+        "successes": 0,
+        "failures": 0,
+        "retries": 0,
+        "timeouts": 0,
+        "fallbacks": 0,
+        "breaker_opens": 0,
+        "breaker_rejections": 0,
+    },
+    "response_cache": {"hits": 0, "misses": 0, "stores": 0, "evictions": 0},
+    "timeseries": {"cache_hits": 0, "from_snapshot": 0, "from_store": 0},
+    "search": {"from_snapshot": 0, "from_store": 0},
+    "freshness": {"probes": 0, "stale_snapshots": 0},
+    "chat_history": {
+        "queued": 0,
+        "flushed": 0,
+        "batches": 0,
+        "failures": 0,
+        "dropped": 0,
+    },
+    "tool_results": {"results": 0, "tokens_in": 0, "tokens_out": 0, "truncated": 0},
+    # Per single-flight group: upstream calls made / identical calls collapsed
+    "single_flight": {},
+    "watcher": {
+        "seeds": 0,
+        "reseeds": 0,
+        "updates": 0,
+        "budget_alerts": 0,
+        "anomaly_alerts": 0,
+        "send_failures": 0,
+    },
+}
 
 CATEGORIES = [
     "Food",
@@ -31,64 +139,2495 @@ CATEGORIES = [
 ]
 
 
-# --- SUPABASE HELPER ---
-def supabase_request(endpoint, method="GET", json_body=None, params=None):
-    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=minimal",
+# --- SINGLE-FLIGHT ---
+# Concurrent identical calls (same signature, still in flight) share one
+# upstream call and its result instead of each issuing their own: the first
+# caller runs it, later ones wait for it. Nothing is cached once it returns.
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        METRICS["single_flight"][name] = {"calls": 0, "collapsed": 0}
+
+    def do(self, key, fn, *args, **kwargs):
+        stats = METRICS["single_flight"][self.name]
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+                stats["calls"] += 1
+            else:
+                stats["collapsed"] += 1
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines; followers await the leader's task"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        METRICS["single_flight"][name] = {"calls": 0, "collapsed": 0}
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        key = (loop, key)
+        stats = METRICS["single_flight"][self.name]
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = loop.create_task(fn(*args, **kwargs))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            stats["calls"] += 1
+        else:
+            stats["collapsed"] += 1
+        # Shielded so one caller going away doesn't cancel everyone's call
+        return await asyncio.shield(task)
+
+
+def flight_key(*parts):
+    """Hashable signature from call arguments (dicts and lists included)"""
+    return json.dumps(parts, sort_keys=True, default=str)
+
+
+supabase_flight = SingleFlight("supabase")
+supabase_flight_async = AsyncSingleFlight("supabase_async")
+
+
+# --- SUPABASE HELPER ---
+# Requests made for a user carry a short-lived JWT signed here with the
+# project's JWT secret; the RLS policies in setup.sql read its user_id
+# claim. The anon key alone carries no user_id and sees no rows, so a
+# leaked anon key cannot read anyone's ledger.
+_user_jwts = {}
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def supabase_user_jwt(user_id):
+    """HS256 JWT for user_id, reused until ten minutes before it expires"""
+    now = int(time.time())
+    cached = _user_jwts.get(user_id)
+    if cached and cached[0] - now > 600:
+        return cached[1]
+    claims = {
+        "role": "authenticated",
+        "aud": "authenticated",
+        "sub": str(user_id),
+        "user_id": str(user_id),
+        "iat": now,
+        "exp": now + 3600,
+    }
+    signing_input = ".".join(
+        _b64url(json.dumps(part, separators=(",", ":")).encode())
+        for part in ({"alg": "HS256", "typ": "JWT"}, claims)
+    )
+    signature = hmac.new(
+        SUPABASE_JWT_SECRET.encode(), signing_input.encode(), hashlib.sha256
+    ).digest()
+    token = f"{signing_input}.{_b64url(signature)}"
+    _user_jwts[user_id] = (claims["exp"], token)
+    return token
+
+
+def supabase_headers(user_id=None, key=None):
+    key = key or SUPABASE_KEY
+    bearer = key
+    if user_id is not None and key == SUPABASE_KEY:
+        if SUPABASE_JWT_SECRET:
+            bearer = supabase_user_jwt(user_id)
+        else:
+            print("Supabase error: SUPABASE_JWT_SECRET is not set")
+    return {
+        "apikey": key,
+        "Authorization": f"Bearer {bearer}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal",
+    }
+
+
+def supabase_request(
+    endpoint, method="GET", json_body=None, params=None, user_id=None, key=None
+):
+    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+    headers = supabase_headers(user_id, key)
+    try:
+        if method == "GET":
+            return supabase_flight.do(
+                flight_key(url, params, user_id),
+                requests.get,
+                url,
+                headers=headers,
+                params=params,
+            )
+        elif method == "POST":
+            return requests.post(url, headers=headers, json=json_body, params=params)
+        elif method == "PATCH":
+            return requests.patch(url, headers=headers, json=json_body, params=params)
+        elif method == "DELETE":
+            return requests.delete(url, headers=headers, params=params)
+    except Exception as e:
+        print(f"Supabase error: {e}")
+        return None
+
+
+# --- ASYNC HTTP ---
+# One shared httpx.AsyncClient (and AsyncGroq on top of it) per event loop,
+# used by the ASGI serving mode. Code that must run in both modes is written
+# as a generator of effects: it yields ("kind", *args) tuples and receives
+# the result, and drive()/drive_async() answer them with blocking or awaited
+# I/O respectively.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def async_http():
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        http = httpx.AsyncClient(
+            timeout=GROQ_TIMEOUT,
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS),
+        )
+        clients = _async_clients[loop] = {
+            "http": http,
+            "groq": AsyncGroq(
+                api_key=GROQ_API_KEY,
+                max_retries=0,
+                timeout=GROQ_TIMEOUT,
+                http_client=http,
+            ),
+        }
+    return clients
+
+
+async def close_async_http():
+    clients = _async_clients.pop(asyncio.get_running_loop(), None)
+    if clients:
+        await clients["http"].aclose()
+
+
+def drive(steps, handlers):
+    """Run an effect generator, answering each effect with a blocking call"""
+    value, error = None, None
+    try:
+        while True:
+            try:
+                effect = steps.throw(error) if error else steps.send(value)
+            except StopIteration as done:
+                return done.value
+            value, error = None, None
+            try:
+                value = handlers[effect[0]](*effect[1:])
+            except Exception as e:
+                error = e
+    finally:
+        # Unwind the generator now if we bail out (e.g. KeyboardInterrupt)
+        steps.close()
+
+
+async def drive_async(steps, handlers):
+    """Same as drive(), but each handler is awaited"""
+    value, error = None, None
+    try:
+        while True:
+            try:
+                effect = steps.throw(error) if error else steps.send(value)
+            except StopIteration as done:
+                return done.value
+            value, error = None, None
+            try:
+                value = await handlers[effect[0]](*effect[1:])
+            except Exception as e:
+                error = e
+    finally:
+        # A cancelled task must unwind the generator so its cleanup runs
+        steps.close()
+
+
+async def supabase_request_async(
+    endpoint, method="GET", json_body=None, params=None, user_id=None
+):
+    headers = supabase_headers(user_id)
+    url = f"{SUPABASE_URL}/rest/v1/{endpoint}"
+    http = async_http()["http"]
+    try:
+        if method == "GET":
+            return await supabase_flight_async.do(
+                flight_key(url, params, user_id),
+                http.get,
+                url,
+                headers=headers,
+                params=params,
+            )
+        return await http.request(
+            method, url, headers=headers, json=json_body, params=params
+        )
+    except Exception as e:
+        print(f"Supabase error: {e}")
+        return None
+
+
+async def telegram_request_async(method, **payload):
+    resp = await async_http()["http"].post(
+        telebot.apihelper.API_URL.format(TOKEN, method), json=payload
+    )
+    if resp.status_code != 200:
+        raise RuntimeError(f"Telegram {method} failed: {resp.text}")
+    return resp.json().get("result")
+
+
+# --- STORAGE ---
+# Typed data-access operations with two interchangeable engines, chosen by
+# STORAGE_BACKEND: Supabase/PostgREST (default) or an embedded SQLite file
+# for single-node deployments, tests and offline benchmarks. Reads return
+# lists/dicts (None when the backend failed); writes return True/False.
+TRANSACTION_COLUMNS = {
+    "expenses": ("id", "item", "amount", "category", "created_at"),
+    "income": ("id", "source", "amount", "created_at"),
+}
+
+
+class SupabaseStore:
+    name = "supabase"
+
+    def _get(self, endpoint, user_id, params=None):
+        resp = supabase_request(endpoint, params=params, user_id=user_id)
+        if not resp or resp.status_code != 200:
+            return None
+        return resp.json()
+
+    async def _get_async(self, endpoint, user_id, params=None):
+        resp = await supabase_request_async(endpoint, params=params, user_id=user_id)
+        if not resp or resp.status_code != 200:
+            return None
+        return resp.json()
+
+    def _write(self, endpoint, user_id, body, method="POST"):
+        resp = supabase_request(
+            endpoint, method=method, json_body=body, user_id=user_id
+        )
+        return bool(resp and resp.status_code in (200, 201, 204))
+
+    # transactions
+    def insert_expense(self, user_id, item, amount, category):
+        row = {"user_id": user_id, "item": item, "amount": amount}
+        return self._write("expenses", user_id, dict(row, category=category))
+
+    def insert_income(self, user_id, amount, source):
+        row = {"user_id": user_id, "amount": amount, "source": source}
+        return self._write("income", user_id, row)
+
+    def insert_many(self, table, user_id, rows):
+        return self._write(table, user_id, rows)
+
+    def scan_transactions(self, table, user_id, after_id=0, limit=1000):
+        cols = ",".join(TRANSACTION_COLUMNS[table])
+        return self._get(
+            f"{table}?select={cols}&user_id=eq.{user_id}&id=gt.{after_id}"
+            f"&order=id.asc&limit={limit}",
+            user_id,
+        )
+
+    def ledger_counts(self, user_id):
+        """(expense rows, income rows) via the ledger_counts RPC"""
+        resp = supabase_request(
+            "rpc/ledger_counts",
+            method="POST",
+            json_body={"p_user_id": user_id},
+            user_id=user_id,
+        )
+        if not resp or resp.status_code != 200 or not resp.json():
+            return None
+        row = resp.json()[0]
+        return int(row["expenses"]), int(row["income"])
+
+    def ledger_page(self, table, user_id, columns, start, end, cursor, limit):
+        params = {
+            "select": ",".join(columns),
+            "user_id": f"eq.{user_id}",
+            "order": "created_at.asc,id.asc",
+            "limit": str(limit),
+        }
+        and_filters = []
+        if start:
+            and_filters.append(f'created_at.gte."{start}"')
+        if end:
+            and_filters.append(f'created_at.lte."{end}"')
+        if cursor:
+            # Values holding reserved characters (. : +) must be quoted
+            ts, row_id = cursor
+            and_filters.append(
+                f'or(created_at.gt."{ts}",and(created_at.eq."{ts}",id.gt.{row_id}))'
+            )
+        if and_filters:
+            params["and"] = f"({','.join(and_filters)})"
+        return self._get(table, user_id, params)
+
+    def timeseries(self, user_id, start, end, granularity, by_category):
+        resp = supabase_request(
+            "rpc/transaction_timeseries",
+            method="POST",
+            json_body={
+                "p_user_id": user_id,
+                "p_start": start,
+                "p_end": end,
+                "p_granularity": granularity,
+                "p_by_category": by_category,
+            },
+            user_id=user_id,
+        )
+        if not resp or resp.status_code != 200:
+            return None
+        return resp.json()
+
+    def search_transactions(self, table, user_id, query, start, end, category, limit):
+        """Trigram-ranked matches via the search_transactions RPC"""
+        resp = supabase_request(
+            "rpc/search_transactions",
+            method="POST",
+            json_body={
+                "p_user_id": user_id,
+                "p_query": query,
+                "p_table": table,
+                "p_start": start,
+                "p_end": end,
+                "p_category": category,
+                "p_limit": limit,
+                "p_min_similarity": SEARCH_MIN_SIMILARITY,
+            },
+            user_id=user_id,
+        )
+        if not resp or resp.status_code != 200:
+            return None
+        return resp.json()
+
+    # subscriptions
+    def query_subscriptions(self, user_id, start=None, end=None, limit=10):
+        filters = [f"user_id=eq.{user_id}"]
+        if start:
+            filters.append(f"created_at=gte.{start}")
+        if end:
+            filters.append(f"created_at=lte.{end}")
+        return self._get(
+            "subscriptions?select=*&" + "&".join(filters) + f"&limit={limit}", user_id
+        )
+
+    def active_subscriptions(self, user_id):
+        return self._get(
+            f"subscriptions?user_id=eq.{user_id}&is_active=eq.true"
+            "&select=id,name,amount,billing_cycle,created_at,next_billing_at",
+            user_id,
+        )
+
+    def materialize_charges(self, now):
+        """Insert every due subscription charge; returns the inserted rows.
+
+        The RPC always bills as of the database's now(); `now` only applies
+        to the SQLite engine."""
+        if not SUPABASE_SERVICE_KEY:
+            print("Billing error: SUPABASE_SERVICE_KEY is not set")
+            return None
+        resp = supabase_request(
+            "rpc/materialize_subscription_charges",
+            method="POST",
+            json_body={"p_max_backfill_days": BILLING_MAX_BACKFILL_DAYS},
+            key=SUPABASE_SERVICE_KEY,
+        )
+        if not resp or resp.status_code != 200:
+            return None
+        return resp.json()
+
+    def add_subscription(self, user_id, name, amount, billing_cycle):
+        row = {
+            "user_id": user_id,
+            "name": name,
+            "amount": amount,
+            "billing_cycle": billing_cycle,
+            "is_active": True,
+        }
+        return self._write("subscriptions", user_id, row)
+
+    def update_subscription(self, user_id, name, fields):
+        return self._write(
+            f"subscriptions?user_id=eq.{user_id}&name=eq.{name}",
+            user_id,
+            fields,
+            method="PATCH",
+        )
+
+    # savings goals
+    def get_goal(self, user_id, name):
+        rows = self._get(f"savings_goals?user_id=eq.{user_id}&name=eq.{name}", user_id)
+        return rows[0] if rows else None
+
+    def insert_goal(self, user_id, name, fields):
+        row = dict(fields, user_id=user_id, name=name)
+        return self._write("savings_goals", user_id, row)
+
+    def update_goal(self, user_id, goal_id, fields):
+        return self._write(
+            f"savings_goals?user_id=eq.{user_id}&id=eq.{goal_id}",
+            user_id,
+            fields,
+            method="PATCH",
+        )
+
+    def active_goals(self, user_id):
+        return self._get(
+            f"savings_goals?user_id=eq.{user_id}&is_active=eq.true"
+            "&select=name,target_amount,current_amount",
+            user_id,
+        )
+
+    # profile and chat history
+    def get_profile(self, user_id):
+        rows = self._get(f"financial_profile?user_id=eq.{user_id}", user_id)
+        return rows[0] if rows else None
+
+    async def get_profile_async(self, user_id):
+        rows = await self._get_async(f"financial_profile?user_id=eq.{user_id}", user_id)
+        return rows[0] if rows else None
+
+    def recent_history(self, user_id, limit=10):
+        """Newest first"""
+        return self._get(
+            f"chat_history?user_id=eq.{user_id}&order=created_at.desc&limit={limit}",
+            user_id,
+        )
+
+    async def recent_history_async(self, user_id, limit=10):
+        return await self._get_async(
+            f"chat_history?user_id=eq.{user_id}&order=created_at.desc&limit={limit}",
+            user_id,
+        )
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS financial_profile (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL UNIQUE,
+    budget REAL DEFAULT 5000,
+    goals TEXT DEFAULT 'Save money',
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')),
+    updated_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    item TEXT,
+    amount REAL NOT NULL,
+    category TEXT DEFAULT 'Uncategorized',
+    user_note TEXT,
+    billing_key TEXT,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE TABLE IF NOT EXISTS income (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    source TEXT,
+    description TEXT,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL CHECK (role IN ('user', 'assistant', 'system')),
+    content TEXT NOT NULL,
+    tool_calls TEXT,
+    tool_results TEXT,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    amount REAL NOT NULL DEFAULT 0,
+    billing_cycle TEXT DEFAULT 'monthly',
+    is_active INTEGER DEFAULT 1,
+    next_billing_at TEXT,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE TABLE IF NOT EXISTS savings_goals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    target_amount REAL NOT NULL DEFAULT 0,
+    current_amount REAL DEFAULT 0,
+    deadline TEXT,
+    is_active INTEGER DEFAULT 1,
+    created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'))
+);
+CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_created ON expenses(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses(user_id, category);
+CREATE INDEX IF NOT EXISTS idx_income_user_created ON income(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active);
+CREATE INDEX IF NOT EXISTS idx_goals_user_active ON savings_goals(user_id, is_active, name);
+"""
+
+# Columns added after a table was first created; applied if missing
+SQLITE_MIGRATIONS = (
+    "ALTER TABLE expenses ADD COLUMN billing_key TEXT",
+    "ALTER TABLE subscriptions ADD COLUMN next_billing_at TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_billing_key "
+    "ON expenses(user_id, billing_key)",
+)
+
+# SQLite has no date_trunc; these produce the same bucket start dates
+SQLITE_BUCKETS = {
+    "day": "date(created_at)",
+    "week": "date(created_at, '-' || ((strftime('%w', created_at) + 6) % 7) || ' days')",
+    "month": "strftime('%Y-%m-01', created_at)",
+}
+
+
+def sqlite_ts(value):
+    """Canonical UTC text so timestamps compare correctly as strings"""
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+class SQLiteStore:
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+            for statement in SQLITE_MIGRATIONS:
+                try:
+                    conn.execute(statement)
+                except sqlite3.OperationalError:
+                    pass  # already applied
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _all(self, sql, args=()):
+        try:
+            return [dict(r) for r in self._conn().execute(sql, args).fetchall()]
+        except sqlite3.Error as e:
+            print(f"SQLite error: {e}")
+            return None
+
+    def _insert(self, table, rows):
+        if not rows:
+            return True
+        # Stamp created_at here so every row uses the canonical text format
+        now = sqlite_ts(datetime.now(timezone.utc))
+        rows = [dict(r, created_at=r.get("created_at") or now) for r in rows]
+        cols = list(rows[0].keys())
+        sql = (
+            f"INSERT INTO {table} ({', '.join(cols)}) "
+            f"VALUES ({', '.join('?' for _ in cols)})"
+        )
+        values = []
+        for r in rows:
+            r = dict(r, created_at=sqlite_ts(r["created_at"]))
+            values.append([r.get(c) for c in cols])
+        try:
+            with self._conn() as conn:
+                conn.executemany(sql, values)
+            return True
+        except sqlite3.Error as e:
+            print(f"SQLite error: {e}")
+            return False
+
+    def _update(self, table, fields, where, args):
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    f"UPDATE {table} SET {sets} WHERE {where}",
+                    list(fields.values()) + list(args),
+                )
+            return True
+        except sqlite3.Error as e:
+            print(f"SQLite error: {e}")
+            return False
+
+    # transactions
+    def insert_expense(self, user_id, item, amount, category):
+        row = {"user_id": user_id, "item": item, "amount": amount}
+        return self._insert("expenses", [dict(row, category=category)])
+
+    def insert_income(self, user_id, amount, source):
+        return self._insert(
+            "income", [{"user_id": user_id, "amount": amount, "source": source}]
+        )
+
+    def insert_many(self, table, user_id, rows):
+        return self._insert(table, rows)
+
+    def scan_transactions(self, table, user_id, after_id=0, limit=1000):
+        return self._all(
+            f"SELECT {', '.join(TRANSACTION_COLUMNS[table])} FROM {table} "
+            "WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, after_id, limit),
+        )
+
+    def ledger_counts(self, user_id):
+        rows = self._all(
+            "SELECT (SELECT COUNT(*) FROM expenses WHERE user_id = ?) AS expenses, "
+            "(SELECT COUNT(*) FROM income WHERE user_id = ?) AS income",
+            (user_id, user_id),
+        )
+        return (rows[0]["expenses"], rows[0]["income"]) if rows else None
+
+    def ledger_page(self, table, user_id, columns, start, end, cursor, limit):
+        where, args = ["user_id = ?"], [user_id]
+        if start:
+            where.append("created_at >= ?")
+            args.append(sqlite_ts(start))
+        if end:
+            where.append("created_at <= ?")
+            args.append(sqlite_ts(end))
+        if cursor:
+            where.append("(created_at, id) > (?, ?)")
+            args.extend(cursor)
+        return self._all(
+            f"SELECT {', '.join(columns)} FROM {table} WHERE {' AND '.join(where)} "
+            "ORDER BY created_at, id LIMIT ?",
+            args + [limit],
+        )
+
+    def timeseries(self, user_id, start, end, granularity, by_category):
+        bucket = SQLITE_BUCKETS[granularity]
+        category = "category" if by_category else "NULL"
+        bounds = (user_id, sqlite_ts(start), sqlite_ts(end))
+        return self._all(
+            f"""SELECT bucket, category, SUM(income) AS income, SUM(expenses) AS expenses
+            FROM (
+                SELECT {bucket} AS bucket, {category} AS category,
+                       0 AS income, amount AS expenses
+                FROM expenses
+                WHERE user_id = ? AND created_at >= ? AND created_at <= ?
+                UNION ALL
+                SELECT {bucket}, NULL, amount, 0
+                FROM income
+                WHERE user_id = ? AND created_at >= ? AND created_at <= ?
+            )
+            GROUP BY bucket, category
+            ORDER BY bucket, category""",
+            bounds + bounds,
+        )
+
+    def search_transactions(self, table, user_id, query, start, end, category, limit):
+        # SQLite has no trigram similarity; the snapshot's in-memory index
+        # answers instead
+        return None
+
+    # subscriptions
+    def query_subscriptions(self, user_id, start=None, end=None, limit=10):
+        where, args = ["user_id = ?"], [user_id]
+        if start:
+            where.append("created_at >= ?")
+            args.append(sqlite_ts(start))
+        if end:
+            where.append("created_at <= ?")
+            args.append(sqlite_ts(end))
+        rows = self._all(
+            f"SELECT * FROM subscriptions WHERE {' AND '.join(where)} LIMIT ?",
+            args + [limit],
+        )
+        for r in rows or []:
+            r["is_active"] = bool(r["is_active"])
+        return rows
+
+    def active_subscriptions(self, user_id):
+        return self._all(
+            "SELECT id, name, amount, billing_cycle, created_at, next_billing_at "
+            "FROM subscriptions WHERE user_id = ? AND is_active = 1",
+            (user_id,),
+        )
+
+    def materialize_charges(self, now):
+        subs = self._all(
+            "SELECT * FROM subscriptions WHERE is_active = 1 "
+            "AND COALESCE(next_billing_at, created_at) <= ?",
+            (sqlite_ts(now),),
+        )
+        if subs is None:
+            return None
+        charges, advances = [], []
+        oldest = now - timedelta(days=BILLING_MAX_BACKFILL_DAYS)
+        for sub in subs:
+            due, next_at = due_charges(sub, now, since=oldest)
+            for due_at in due:
+                charges.append(
+                    {
+                        "user_id": sub["user_id"],
+                        "item": sub["name"],
+                        "amount": sub["amount"],
+                        "category": SUBSCRIPTION_CATEGORY,
+                        "created_at": sqlite_ts(due_at),
+                        "billing_key": billing_key(sub["id"], due_at),
+                    }
+                )
+            advances.append((sqlite_ts(next_at), sub["id"]))
+        inserted = []
+        try:
+            with self._conn() as conn:
+                for c in charges:
+                    cur = conn.execute(
+                        "INSERT OR IGNORE INTO expenses (user_id, item, amount, "
+                        "category, created_at, billing_key) VALUES (?, ?, ?, ?, ?, ?)",
+                        tuple(c.values()),
+                    )
+                    if cur.rowcount:
+                        inserted.append(c)
+                conn.executemany(
+                    "UPDATE subscriptions SET next_billing_at = ? WHERE id = ?",
+                    advances,
+                )
+        except sqlite3.Error as e:
+            print(f"SQLite error: {e}")
+            return None
+        return inserted
+
+    def add_subscription(self, user_id, name, amount, billing_cycle):
+        row = {
+            "user_id": user_id,
+            "name": name,
+            "amount": amount,
+            "billing_cycle": billing_cycle,
+            "is_active": 1,
+        }
+        return self._insert("subscriptions", [row])
+
+    def update_subscription(self, user_id, name, fields):
+        return self._update(
+            "subscriptions", fields, "user_id = ? AND name = ?", (user_id, name)
+        )
+
+    # savings goals
+    def get_goal(self, user_id, name):
+        rows = self._all(
+            "SELECT * FROM savings_goals WHERE user_id = ? AND name = ? LIMIT 1",
+            (user_id, name),
+        )
+        return rows[0] if rows else None
+
+    def insert_goal(self, user_id, name, fields):
+        return self._insert("savings_goals", [dict(fields, user_id=user_id, name=name)])
+
+    def update_goal(self, user_id, goal_id, fields):
+        return self._update(
+            "savings_goals", fields, "user_id = ? AND id = ?", (user_id, goal_id)
+        )
+
+    def active_goals(self, user_id):
+        return self._all(
+            "SELECT name, target_amount, current_amount FROM savings_goals "
+            "WHERE user_id = ? AND is_active = 1",
+            (user_id,),
+        )
+
+    # profile and chat history
+    def get_profile(self, user_id):
+        rows = self._all(
+            "SELECT * FROM financial_profile WHERE user_id = ?", (user_id,)
+        )
+        return rows[0] if rows else None
+
+    def recent_history(self, user_id, limit=10):
+        """Newest first"""
+        return self._all(
+            "SELECT * FROM chat_history WHERE user_id = ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        )
+
+
+store = SQLiteStore(SQLITE_PATH) if STORAGE_BACKEND == "sqlite" else SupabaseStore()
+
+
+# --- GROQ RESILIENCE ---
+class GroqUnavailable(Exception):
+    """Raised when neither the primary nor the fallback model could answer"""
+
+
+_groq_lock = threading.Lock()
+_groq_breakers = {}
+
+
+def _breaker(model):
+    return _groq_breakers.setdefault(
+        model, {"state": "closed", "failures": 0, "opened_at": 0.0}
+    )
+
+
+def _breaker_allows(model):
+    with _groq_lock:
+        b = _breaker(model)
+        if b["state"] == "open":
+            if time.monotonic() - b["opened_at"] < GROQ_BREAKER_COOLDOWN:
+                return False
+            # Cooldown elapsed: let a single probe request through
+            b["state"] = "half_open"
+            return True
+        if b["state"] == "half_open":
+            return False
+        return True
+
+
+def _breaker_record(model, ok):
+    with _groq_lock:
+        b = _breaker(model)
+        if ok:
+            b.update(state="closed", failures=0)
+            return
+        b["failures"] += 1
+        if b["state"] == "half_open" or b["failures"] >= GROQ_BREAKER_THRESHOLD:
+            if b["state"] != "open":
+                METRICS["groq"]["breaker_opens"] += 1
+            b.update(state="open", opened_at=time.monotonic())
+
+
+def _breaker_release(model):
+    """Return an unsettled half-open probe's slot so the next call can probe"""
+    with _groq_lock:
+        b = _breaker(model)
+        if b["state"] == "half_open":
+            b["state"] = "open"
+
+
+def _is_retryable(exc):
+    if isinstance(exc, APIConnectionError):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return False
+
+
+def _retry_delay(exc, attempt):
+    retry_after = None
+    if isinstance(exc, APIStatusError):
+        retry_after = exc.response.headers.get("retry-after")
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), 10.0)
+    except ValueError:
+        pass
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(8.0, 0.5 * (2**attempt)))
+
+
+def _groq_attempts(model, messages, deadline, expires, kwargs):
+    attempt = 0
+    while True:
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            METRICS["groq"]["timeouts"] += 1
+            _breaker_release(model)
+            raise TimeoutError(f"Groq deadline of {deadline}s exceeded")
+        try:
+            response = yield ("create", model, messages, remaining, kwargs)
+        except BaseException as e:
+            if not _is_retryable(e):
+                # Always settle the breaker, or a half-open probe ending in a
+                # 400 or a cancellation would leave it half_open for good
+                if isinstance(e, APIStatusError):
+                    _breaker_record(model, True)
+                else:
+                    _breaker_release(model)
+                raise
+            _breaker_record(model, False)
+            if attempt >= GROQ_MAX_RETRIES or not _breaker_allows(model):
+                raise
+            delay = _retry_delay(e, attempt)
+            if delay >= expires - time.monotonic():
+                raise
+            METRICS["groq"]["retries"] += 1
+            print(f"Groq {model} attempt {attempt + 1} failed ({e}), retrying")
+            yield ("sleep", delay)
+            attempt += 1
+            continue
+        _breaker_record(model, True)
+        return response
+
+
+def _groq_chat_steps(messages, model, fallback_model, deadline, kwargs):
+    model = model or GROQ_MODEL
+    fallback_model = fallback_model or GROQ_FALLBACK_MODEL
+    deadline = deadline or GROQ_TIMEOUT
+    # One budget for the whole call: the fallback only gets what is left
+    expires = time.monotonic() + deadline
+    METRICS["groq"]["calls"] += 1
+    candidates = [model] + ([fallback_model] if fallback_model != model else [])
+    last_error = None
+    for candidate in candidates:
+        if not _breaker_allows(candidate):
+            METRICS["groq"]["breaker_rejections"] += 1
+            continue
+        try:
+            response = yield from _groq_attempts(
+                candidate, messages, deadline, expires, kwargs
+            )
+        except Exception as e:
+            if not (_is_retryable(e) or isinstance(e, TimeoutError)):
+                METRICS["groq"]["failures"] += 1
+                raise
+            print(f"Groq {candidate} unavailable: {e}")
+            last_error = e
+            continue
+        if candidate != model:
+            METRICS["groq"]["fallbacks"] += 1
+        METRICS["groq"]["successes"] += 1
+        return response
+    METRICS["groq"]["failures"] += 1
+    raise GroqUnavailable(str(last_error) if last_error else "circuit open")
+
+
+def _groq_create(model, messages, timeout, kwargs):
+    return groq_client.chat.completions.create(
+        model=model, messages=messages, timeout=timeout, **kwargs
+    )
+
+
+async def _groq_create_async(model, messages, timeout, kwargs):
+    return await async_http()["groq"].chat.completions.create(
+        model=model, messages=messages, timeout=timeout, **kwargs
+    )
+
+
+def groq_chat(messages, model=None, fallback_model=None, deadline=None, **kwargs):
+    """Chat completion with deadline, retries, circuit breaker and model fallback"""
+    steps = _groq_chat_steps(messages, model, fallback_model, deadline, kwargs)
+    return drive(steps, {"create": _groq_create, "sleep": time.sleep})
+
+
+async def groq_chat_async(
+    messages, model=None, fallback_model=None, deadline=None, **kwargs
+):
+    steps = _groq_chat_steps(messages, model, fallback_model, deadline, kwargs)
+    return await drive_async(
+        steps, {"create": _groq_create_async, "sleep": asyncio.sleep}
+    )
+
+
+def groq_metrics():
+    with _groq_lock:
+        breakers = {
+            m: {"state": b["state"], "failures": b["failures"]}
+            for m, b in _groq_breakers.items()
+        }
+    return dict(METRICS["groq"], breakers=breakers)
+
+
+# --- CATEGORIZATION ---
+# Item text -> category, so repeat items never cost an LLM call
+_category_lock = threading.Lock()
+_category_cache = OrderedDict()
+
+
+def _category_key(item_text):
+    return " ".join((item_text or "").lower().split())
+
+
+def cached_category(item_text):
+    with _category_lock:
+        return _category_cache.get(_category_key(item_text))
+
+
+def remember_category(item_text, category):
+    key = _category_key(item_text)
+    if not key or category not in CATEGORIES:
+        return
+    with _category_lock:
+        _category_cache[key] = category
+        _category_cache.move_to_end(key)
+        while len(_category_cache) > CATEGORY_CACHE_SIZE:
+            _category_cache.popitem(last=False)
+
+
+categorization_flight = SingleFlight("categorization")
+
+
+def strict_categorization(item_text):
+    cached = cached_category(item_text)
+    if cached:
+        return cached
+    if not GROQ_API_KEY:
+        return "Misc"
+    # The same item logged from several chats at once costs one prompt
+    return categorization_flight.do(
+        _category_key(item_text), _categorize_with_llm, item_text
+    )
+
+
+def _categorize_with_llm(item_text):
+    categories_str = ", ".join(CATEGORIES)
+    prompt = f"""Categorize this expense into EXACTLY ONE of these categories: {categories_str}.
+Output ONLY the category name, nothing else.
+Expense: "{item_text}"
+Category:"""
+    try:
+        response = groq_chat(
+            [{"role": "user", "content": prompt}],
+            deadline=GROQ_CATEGORIZATION_TIMEOUT,
+            temperature=0.3,
+        )
+        result = response.choices[0].message.content.strip()
+        for cat in CATEGORIES:
+            if cat.lower() in result.lower():
+                remember_category(item_text, cat)
+                return cat
+        return "Misc"
+    except Exception as e:
+        print(f"Categorization error: {e}")
+        return "Misc"
+
+
+def batch_categorization(items):
+    """Categorize many items: cache first, then one LLM prompt for the rest"""
+    result = {}
+    pending = []
+    for item in items:
+        cached = cached_category(item)
+        if cached:
+            result[item] = cached
+        elif item not in pending:
+            pending.append(item)
+    if not pending:
+        return result
+    if not GROQ_API_KEY:
+        return dict(result, **{item: "Misc" for item in pending})
+    listing = "\n".join(f"{i + 1}. {item}" for i, item in enumerate(pending))
+    prompt = f"""Categorize each expense into EXACTLY ONE of these categories: {", ".join(CATEGORIES)}.
+Output one line per expense in the form "<number>: <category>", nothing else.
+{listing}"""
+    answers = {}
+    try:
+        response = groq_chat(
+            [{"role": "user", "content": prompt}],
+            deadline=GROQ_CATEGORIZATION_TIMEOUT * 2,
+            temperature=0.1,
+        )
+        for line in (response.choices[0].message.content or "").splitlines():
+            m = re.match(r"\s*(\d+)[.):]?\s*:?\s*(.+)", line)
+            if m:
+                answers[int(m.group(1))] = m.group(2)
+    except Exception as e:
+        print(f"Batch categorization error: {e}")
+    for i, item in enumerate(pending):
+        answer = (answers.get(i + 1) or "").lower()
+        category = next((c for c in CATEGORIES if c.lower() in answer), "Misc")
+        if answer:
+            remember_category(item, category)
+        result[item] = category
+    return result
+
+
+# --- RESPONSE SANITIZER ---
+def sanitize_response(text):
+    """Strip any raw function tags or XML-like function calls from response"""
+    if not text:
+        return ""
+    text = re.sub(r"<function=[^>]*>", "", text)
+    text = re.sub(r"</function>", "", text)
+    text = re.sub(r"\\[function:[^\\]*\\]", "", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text
+
+
+# --- CROSS-INSTANCE FRESHNESS ---
+# Several instances (serverless copies, gunicorn workers) can serve one user
+# and each holds its own snapshot and caches, so writes made elsewhere must
+# be noticed. Expenses and income are append-only, which makes a user's row
+# counts a version: ledger_counts() probes them (reused for
+# LEDGER_PROBE_TTL seconds, dropped on our own writes), data_version()
+# folds them into every cache key, and a snapshot holding other counts is
+# reloaded. A failed probe keeps serving from memory.
+_ledger_lock = threading.Lock()
+_ledger_probes = {}
+
+
+def ledger_counts(user_id):
+    with _ledger_lock:
+        probe = _ledger_probes.get(user_id)
+    if probe and time.monotonic() - probe[0] < LEDGER_PROBE_TTL:
+        return probe[1]
+    counts = store.ledger_counts(user_id)
+    METRICS["freshness"]["probes"] += 1
+    if counts is not None:
+        with _ledger_lock:
+            _ledger_probes[user_id] = (time.monotonic(), tuple(counts))
+    return counts and tuple(counts)
+
+
+def forget_ledger_counts(user_id):
+    with _ledger_lock:
+        _ledger_probes.pop(user_id, None)
+
+
+# --- RESPONSE CACHE ---
+# Answers are keyed on (user, data version, normalized question). Every write
+# bumps the user's data version (and other instances' writes change its
+# ledger counts), so stale answers simply stop matching.
+_CACHE_STOPWORDS = set(
+    "a an the please pls hey hi me my i did do is are what whats s how much "
+    "tell show give can you so far on for of in to and".split()
+)
+_PUNCT_TABLE = str.maketrans({c: " " for c in string.punctuation + "?!"})
+
+_cache_lock = threading.Lock()
+_response_cache = OrderedDict()
+_data_versions = {}
+
+
+def data_version(user_id):
+    return _data_versions.get(user_id, 0), ledger_counts(user_id)
+
+
+def bump_data_version(user_id):
+    with _cache_lock:
+        _data_versions[user_id] = _data_versions.get(user_id, 0) + 1
+    forget_ledger_counts(user_id)
+
+
+def normalize_question(text):
+    """Reduce a question to an order-insensitive bag of meaningful tokens"""
+    tokens = (text or "").lower().replace("'", "").translate(_PUNCT_TABLE).split()
+    words = set()
+    for tok in tokens:
+        if tok in _CACHE_STOPWORDS:
+            continue
+        if len(tok) > 5 and tok.endswith("ing"):
+            tok = tok[:-3]
+        elif len(tok) > 3 and tok.endswith("s") and tok[-2] not in "siu":
+            tok = tok[:-1]
+        words.add(tok)
+    return " ".join(sorted(words))
+
+
+def response_cache_key(user_id, text, version=None):
+    normalized = normalize_question(text)
+    if not normalized:
+        return None
+    return (user_id, version or data_version(user_id), normalized)
+
+
+def response_cache_get(key):
+    stats = METRICS["response_cache"]
+    if key is None:
+        return None
+    with _cache_lock:
+        entry = _response_cache.get(key)
+        if entry and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+            _response_cache.move_to_end(key)
+            stats["hits"] += 1
+            return entry[1]
+        if entry:
+            del _response_cache[key]
+        stats["misses"] += 1
+        return None
+
+
+def response_cache_put(key, response):
+    if key is None or RESPONSE_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        # A write landed while this answer was being computed (key[1] is
+        # data_version(): the local write counter, then the ledger counts)
+        if key[1][0] != _data_versions.get(key[0], 0):
+            return
+        _response_cache[key] = (time.monotonic(), response)
+        _response_cache.move_to_end(key)
+        METRICS["response_cache"]["stores"] += 1
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+            METRICS["response_cache"]["evictions"] += 1
+
+
+def response_cache_metrics():
+    stats = METRICS["response_cache"]
+    lookups = stats["hits"] + stats["misses"]
+    with _cache_lock:
+        size = len(_response_cache)
+    return dict(
+        stats,
+        size=size,
+        max_size=RESPONSE_CACHE_SIZE,
+        hit_rate=round(stats["hits"] / lookups, 4) if lookups else 0.0,
+    )
+
+
+# --- TRANSACTION SNAPSHOT ---
+# Columnar in-memory copy of a user's expenses and income. Loaded once per
+# SNAPSHOT_TTL, kept fresh by appending our own writes, and queried with
+# vectorized NumPy operations instead of re-downloading JSON rows.
+EXPENSE, INCOME = 0, 1
+BUCKET_SECONDS = {"day": 86400, "week": 7 * 86400}
+
+
+def to_epoch(value):
+    """ISO string or datetime -> epoch seconds (naive values are UTC)"""
+    if not value:
+        return 0
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def _iso_date(epoch):
+    return datetime.fromtimestamp(int(epoch), tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+class TransactionSnapshot:
+    def __init__(self, capacity=256):
+        self.size = 0
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.amount = np.empty(capacity, dtype=np.float64)
+        self.kind = np.empty(capacity, dtype=np.int8)
+        self.cat = np.empty(capacity, dtype=np.int16)
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.items = []
+        self.categories = list(CATEGORIES)
+        self._codes = {c: i for i, c in enumerate(self.categories)}
+        self._sorted = True
+        # Rows per kind, compared with the store's by the freshness probe
+        self.counts = [0, 0]
+        self.loaded_at = time.monotonic()
+        self.search_index = None
+
+    def _code(self, category):
+        if category not in self._codes:
+            self._codes[category] = len(self.categories)
+            self.categories.append(category)
+        return self._codes[category]
+
+    def _grow(self, needed):
+        capacity = len(self.ts)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("ts", "amount", "kind", "cat", "ids"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[: self.size] = old[: self.size]
+            setattr(self, name, new)
+
+    def append(self, ts, amount, kind, category=None, item="", row_id=0):
+        self._grow(self.size + 1)
+        i = self.size
+        if i and ts < self.ts[i - 1]:
+            self._sorted = False
+        self.ts[i] = ts
+        self.amount[i] = amount
+        self.kind[i] = kind
+        self.cat[i] = self._code(category or "Misc") if kind == EXPENSE else -1
+        self.ids[i] = row_id or 0
+        self.items.append(item or "")
+        self.counts[kind] += 1
+        self.size += 1
+
+    def _ensure_sorted(self):
+        if self._sorted:
+            return
+        n = self.size
+        order = np.argsort(self.ts[:n], kind="stable")
+        for name in ("ts", "amount", "kind", "cat", "ids"):
+            col = getattr(self, name)
+            col[:n] = col[:n][order]
+        self.items = [self.items[i] for i in order]
+        self._sorted = True
+
+    def _range(self, start=None, end=None):
+        """Index bounds [lo, hi) for start <= ts <= end via binary search"""
+        ts = self.ts[: self.size]
+        lo = 0 if start is None else int(np.searchsorted(ts, to_epoch(start), "left"))
+        hi = (
+            self.size
+            if end is None
+            else int(np.searchsorted(ts, to_epoch(end), "right"))
+        )
+        return lo, max(lo, hi)
+
+    def totals(self, start=None, end=None):
+        lo, hi = self._range(start, end)
+        kind = self.kind[lo:hi]
+        amount = self.amount[lo:hi]
+        income = float(amount[kind == INCOME].sum())
+        expenses = float(amount[kind == EXPENSE].sum())
+        return {"income": income, "expenses": expenses, "net": income - expenses}
+
+    def by_category(self, start=None, end=None):
+        lo, hi = self._range(start, end)
+        mask = self.kind[lo:hi] == EXPENSE
+        sums = np.bincount(
+            self.cat[lo:hi][mask],
+            weights=self.amount[lo:hi][mask],
+            minlength=len(self.categories),
+        )
+        return {self.categories[i]: round(float(v), 2) for i, v in enumerate(sums) if v}
+
+    def select(
+        self, kind=EXPENSE, start=None, end=None, category=None, filter_item=None
+    ):
+        """Absolute indices of matching rows, in chronological order"""
+        lo, hi = self._range(start, end)
+        mask = self.kind[lo:hi] == kind
+        if category:
+            code = self._codes.get(category)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            mask &= self.cat[lo:hi] == code
+        idx = np.flatnonzero(mask) + lo
+        if filter_item:
+            needle = filter_item.lower()
+            idx = idx[[needle in self.items[i].lower() for i in idx]]
+        return idx
+
+    def top(self, n=10, kind=EXPENSE, start=None, end=None):
+        idx = self.select(kind, start, end)
+        if len(idx) > n:
+            idx = idx[np.argpartition(-self.amount[idx], n - 1)[:n]]
+        return idx[np.argsort(-self.amount[idx], kind="stable")]
+
+    def recent(self, n=10, kind=EXPENSE):
+        return self.select(kind)[-n:][::-1]
+
+    def series(self, start=None, end=None, granularity="day", by_category=False):
+        lo, hi = self._range(start, end)
+        if hi == lo:
+            return []
+        ts = self.ts[lo:hi]
+        if granularity == "month":
+            months = ts.astype("datetime64[s]").astype("datetime64[M]")
+            bucket = months.astype("datetime64[s]").astype(np.int64)
+        elif granularity == "week":
+            days = ts // 86400
+            # 1970-01-01 was a Thursday; shift so buckets start on Monday
+            bucket = (days - (days + 3) % 7) * 86400
+        else:
+            bucket = ts - ts % BUCKET_SECONDS["day"]
+        keys, inverse = np.unique(bucket, return_inverse=True)
+        kind = self.kind[lo:hi]
+        amount = self.amount[lo:hi]
+        income = np.bincount(
+            inverse, weights=amount * (kind == INCOME), minlength=len(keys)
+        )
+        expenses = np.bincount(
+            inverse, weights=amount * (kind == EXPENSE), minlength=len(keys)
+        )
+        out = [
+            {
+                "bucket": _iso_date(k),
+                "income": round(float(inc), 2),
+                "expenses": round(float(exp), 2),
+                "net": round(float(inc - exp), 2),
+            }
+            for k, inc, exp in zip(keys, income, expenses)
+        ]
+        if by_category:
+            mask = kind == EXPENSE
+            ncat = len(self.categories)
+            flat = np.bincount(
+                inverse[mask] * ncat + self.cat[lo:hi][mask],
+                weights=amount[mask],
+                minlength=len(keys) * ncat,
+            ).reshape(len(keys), ncat)
+            for row, sums in zip(out, flat):
+                row["categories"] = {
+                    self.categories[c]: round(float(v), 2)
+                    for c, v in enumerate(sums)
+                    if v
+                }
+        return out
+
+    def rows(self, idx):
+        out = []
+        for i in idx:
+            row = {
+                "id": int(self.ids[i]) or None,
+                "amount": float(self.amount[i]),
+                "created_at": datetime.fromtimestamp(
+                    int(self.ts[i]), tz=timezone.utc
+                ).isoformat(),
+            }
+            if self.kind[i] == EXPENSE:
+                row["item"] = self.items[i]
+                row["category"] = self.categories[self.cat[i]]
+            else:
+                row["source"] = self.items[i]
+            out.append(row)
+        return out
+
+
+_snapshot_lock = threading.Lock()
+_snapshots = OrderedDict()
+
+
+def _fetch_all(table, user_id):
+    """Page through a table by id so PostgREST's row cap never truncates it"""
+    rows = []
+    last_id = 0
+    while True:
+        page = store.scan_transactions(table, user_id, last_id, SNAPSHOT_PAGE_SIZE)
+        if page is None:
+            return None
+        rows.extend(page)
+        if len(page) < SNAPSHOT_PAGE_SIZE:
+            return rows
+        last_id = page[-1]["id"]
+
+
+def load_snapshot(user_id):
+    expenses = _fetch_all("expenses", user_id)
+    income = _fetch_all("income", user_id)
+    if expenses is None or income is None:
+        return None
+    snap = TransactionSnapshot(capacity=max(256, len(expenses) + len(income)))
+    for e in expenses:
+        snap.append(
+            to_epoch(e.get("created_at")),
+            float(e.get("amount") or 0),
+            EXPENSE,
+            e.get("category") or "Misc",
+            e.get("item"),
+            e.get("id"),
+        )
+    for i in income:
+        snap.append(
+            to_epoch(i.get("created_at")),
+            float(i.get("amount") or 0),
+            INCOME,
+            item=i.get("source"),
+            row_id=i.get("id"),
+        )
+    snap._ensure_sorted()
+    return snap
+
+
+snapshot_flight = SingleFlight("snapshot")
+
+
+def snapshot_is_fresh(user_id, snap):
+    """Within SNAPSHOT_TTL and holding every row the store has"""
+    if time.monotonic() - snap.loaded_at >= SNAPSHOT_TTL:
+        return False
+    counts = ledger_counts(user_id)
+    if counts is None or counts == tuple(snap.counts):
+        return True
+    METRICS["freshness"]["stale_snapshots"] += 1
+    return False
+
+
+def warm_snapshot(user_id):
+    """The cached snapshot if it is still fresh, without loading one"""
+    with _snapshot_lock:
+        snap = _snapshots.get(user_id)
+    return snap if snap and snapshot_is_fresh(user_id, snap) else None
+
+
+def get_snapshot(user_id):
+    with _snapshot_lock:
+        snap = _snapshots.get(user_id)
+        if snap:
+            _snapshots.move_to_end(user_id)
+    if snap and snapshot_is_fresh(user_id, snap):
+        return snap
+    fresh = snapshot_flight.do(user_id, load_snapshot, user_id)
+    if fresh is None:
+        return snap
+    with _snapshot_lock:
+        _snapshots[user_id] = fresh
+        _snapshots.move_to_end(user_id)
+        while len(_snapshots) > SNAPSHOT_MAX_USERS:
+            _snapshots.popitem(last=False)
+    return fresh
+
+
+def snapshot_append(user_id, kind, amount, category=None, item="", ts=None):
+    """Apply one of our own writes to a loaded snapshot without refetching"""
+    with _snapshot_lock:
+        snap = _snapshots.get(user_id)
+        if snap:
+            if ts is None:
+                ts = to_epoch(datetime.now(timezone.utc))
+            if snap.size and ts < snap.ts[snap.size - 1]:
+                # Readers use the columns and row indices without the lock,
+                # so a shared snapshot is never reordered: a backdated row
+                # (imports, billing backfill) drops it and the next
+                # get_snapshot() loads a sorted one
+                del _snapshots[user_id]
+            else:
+                snap.append(ts, amount, kind, category, item)
+    # The store has this row now too; re-probe rather than reload over it
+    forget_ledger_counts(user_id)
+
+
+# --- TIMESERIES ---
+# Income/expense/net per day, week or month. A warm snapshot answers locally;
+# otherwise the store buckets server-side (date_trunc in the
+# transaction_timeseries RPC from setup.sql, or strftime in SQLite) so only
+# bucket rows cross the wire. Results are cached per
+# (user, data version, range, granularity).
+GRANULARITIES = ("day", "week", "month")
+DEFAULT_TIMESERIES_RANGE = {"day": 30, "week": 84, "month": 365}
+
+_timeseries_lock = threading.Lock()
+_timeseries_cache = OrderedDict()
+
+
+def _timeseries_from_store(user_id, start, end, granularity, by_category):
+    rows = store.timeseries(user_id, start, end, granularity, by_category)
+    if rows is None:
+        return None
+    buckets = OrderedDict()
+    for r in rows:
+        row = buckets.setdefault(
+            r["bucket"][:10],
+            {"bucket": r["bucket"][:10], "income": 0.0, "expenses": 0.0},
+        )
+        income = float(r.get("income") or 0)
+        expenses = float(r.get("expenses") or 0)
+        row["income"] += income
+        row["expenses"] += expenses
+        if by_category:
+            cats = row.setdefault("categories", {})
+            if r.get("category") and expenses:
+                cats[r["category"]] = round(cats.get(r["category"], 0) + expenses, 2)
+    out = []
+    for row in buckets.values():
+        row["income"] = round(row["income"], 2)
+        row["expenses"] = round(row["expenses"], 2)
+        row["net"] = round(row["income"] - row["expenses"], 2)
+        out.append(row)
+    return out
+
+
+def get_timeseries(user_id, granularity="day", start=None, end=None, by_category=False):
+    if granularity not in GRANULARITIES:
+        granularity = "day"
+    now = datetime.now()
+    if not start:
+        start = (now - timedelta(days=DEFAULT_TIMESERIES_RANGE[granularity])).strftime(
+            "%Y-%m-%d"
+        )
+    # Default to the end of today so the cache key stays stable all day
+    end = end or (now + timedelta(days=1)).strftime("%Y-%m-%d")
+    key = (user_id, data_version(user_id), start, end, granularity, bool(by_category))
+    with _timeseries_lock:
+        if key in _timeseries_cache:
+            _timeseries_cache.move_to_end(key)
+            METRICS["timeseries"]["cache_hits"] += 1
+            return _timeseries_cache[key]
+    snap = warm_snapshot(user_id)
+    if snap:
+        series = snap.series(start, end, granularity, by_category)
+        METRICS["timeseries"]["from_snapshot"] += 1
+    else:
+        series = _timeseries_from_store(user_id, start, end, granularity, by_category)
+        if series is None:
+            return None
+        METRICS["timeseries"]["from_store"] += 1
+    with _timeseries_lock:
+        _timeseries_cache[key] = series
+        while len(_timeseries_cache) > TIMESERIES_CACHE_SIZE:
+            _timeseries_cache.popitem(last=False)
+    return series
+
+
+# --- FUZZY SEARCH ---
+# Item/source search ranked by trigram similarity, so "starbux" finds
+# "Starbucks" and "uber eats" finds "UberEats". Labels are compared on
+# search_key() (letters and digits only, lower-cased) with pg_trgm's
+# padding, matching the search_key() function and GIN indexes in setup.sql.
+# A warm snapshot answers from an in-memory trigram index over its distinct
+# labels; otherwise the search_transactions RPC does. SQLite and a failed
+# RPC fall back to loading the snapshot.
+def search_key(text):
+    return "".join(ch for ch in (text or "").lower() if ch.isalnum())
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    def __init__(self):
+        self.keys = {}  # label -> search key
+        self.grams = {}  # search key -> trigram set
+        self.postings = {}  # trigram -> search keys containing it
+        self.indexed = 0
+
+    def add(self, label):
+        if label in self.keys:
+            return
+        key = self.keys[label] = search_key(label)
+        if not key or key in self.grams:
+            return
+        self.grams[key] = trigrams(key)
+        for gram in self.grams[key]:
+            self.postings.setdefault(gram, set()).add(key)
+
+    def match(self, query, min_similarity=None):
+        """{search key: similarity} for keys similar to or containing query"""
+        if min_similarity is None:
+            min_similarity = SEARCH_MIN_SIMILARITY
+        q = search_key(query)
+        if not q:
+            return {}
+        q_grams = trigrams(q)
+        shared = {}
+        for gram in q_grams:
+            for key in self.postings.get(gram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        scores = {}
+        for key, n in shared.items():
+            score = n / (len(q_grams) + len(self.grams[key]) - n)
+            if score >= min_similarity or q in key:
+                scores[key] = score
+        return scores
+
+
+def snapshot_search_index(snap):
+    """The snapshot's label index, topped up with rows appended since"""
+    with _snapshot_lock:
+        index = snap.search_index
+        if index is None:
+            index = snap.search_index = TrigramIndex()
+        # Shared snapshots only ever grow at the end, so rows before
+        # index.indexed are already in the index
+        for label in snap.items[index.indexed : snap.size]:
+            index.add(label)
+        index.indexed = snap.size
+    return index
+
+
+def search_snapshot(snap, query, kind=EXPENSE, start=None, end=None, category=None):
+    """Matching row indices, best match first (then newest), and their scores"""
+    scores = snapshot_search_index(snap).match(query)
+    if not scores:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    keys = snap.search_index.keys
+    idx = snap.select(kind, start, end, category)
+    row_scores = np.array([scores.get(keys.get(snap.items[i]), -1.0) for i in idx])
+    hit = row_scores >= 0
+    idx, row_scores = idx[hit], row_scores[hit]
+    order = np.lexsort((-snap.ts[idx], -row_scores))
+    return idx[order], row_scores[order]
+
+
+def search_transactions(
+    user_id, query, table="expenses", start=None, end=None, category=None, limit=20
+):
+    """Ranked fuzzy matches as row dicts with a "score"; limit=None for all"""
+    kind = EXPENSE if table == "expenses" else INCOME
+    snap = warm_snapshot(user_id)
+    if not snap:
+        rows = store.search_transactions(
+            table, user_id, query, start, end, category, limit
+        )
+        if rows is not None:
+            METRICS["search"]["from_store"] += 1
+            out = []
+            for r in rows:
+                row = {
+                    "id": r["id"],
+                    "amount": float(r["amount"]),
+                    "created_at": r["created_at"],
+                }
+                if kind == EXPENSE:
+                    row.update(item=r["label"], category=r["category"])
+                else:
+                    row["source"] = r["label"]
+                row["score"] = round(float(r["score"]), 3)
+                out.append(row)
+            return out
+        snap = get_snapshot(user_id)
+        if snap is None:
+            return None
+    METRICS["search"]["from_snapshot"] += 1
+    idx, scores = search_snapshot(snap, query, kind, start, end, category)
+    if limit:
+        idx, scores = idx[:limit], scores[:limit]
+    rows = snap.rows(idx)
+    for row, score in zip(rows, scores):
+        row["score"] = round(float(score), 3)
+    return rows
+
+
+# --- BULK IMPORT ---
+# Streams a bank/CSV export row by row, drops rows already stored (hash of
+# date, amount, item; matched one-for-one so same-day repeats survive), categorizes each chunk with one cached/LLM pass and
+# inserts it with a single PostgREST array POST. Re-running the same file is
+# safe; skip=N resumes after the last reported row.
+IMPORT_COLUMNS = {
+    "date": ("date", "transaction date", "booking date", "posted", "created_at"),
+    "amount": ("amount", "sum", "value", "suma"),
+    "debit": ("debit", "withdrawal", "paid out"),
+    "credit": ("credit", "deposit", "paid in"),
+    "item": ("item", "description", "details", "payee", "merchant", "name", "memo"),
+    "category": ("category",),
+    "type": ("type",),
+}
+IMPORT_DATE_FORMATS = (
+    "%Y-%m-%d",
+    "%d.%m.%Y",
+    "%d/%m/%Y",
+    "%Y/%m/%d",
+    "%d-%m-%Y",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+
+def _import_columns(fieldnames):
+    lookup = {(f or "").strip().lower(): f for f in fieldnames or []}
+    return {
+        key: next((lookup[a] for a in aliases if a in lookup), None)
+        for key, aliases in IMPORT_COLUMNS.items()
+    }
+
+
+def parse_amount(text):
+    text = re.sub(r"[^0-9,.\-]", "", (text or "").strip())
+    if not text or text in "-.,":
+        return None
+    if "," in text and "." in text:
+        # Whichever separator comes last is the decimal point
+        thousands = "," if text.rfind(",") < text.rfind(".") else "."
+        text = text.replace(thousands, "")
+    text = text.replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def parse_date(text):
+    text = (text or "").strip()
+    for fmt in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        return None
+
+
+def row_fingerprint(day, amount, item):
+    raw = f"{day}|{abs(amount):.2f}|{_category_key(item)}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def iter_statement_rows(lines, positive_is_income=False):
+    """Yield normalized transactions from CSV lines without reading them all.
+
+    Debit/Credit columns decide the direction themselves (credit = income).
+    positive_is_income only applies to a single signed amount column; by
+    default every such row is an expense.
+    """
+    reader = csv.DictReader(lines)
+    cols = _import_columns(reader.fieldnames)
+    for raw in reader:
+        when = parse_date(raw.get(cols["date"]) if cols["date"] else None)
+        item = (raw.get(cols["item"]) or "").strip() if cols["item"] else ""
+        amount = parse_amount(raw.get(cols["amount"])) if cols["amount"] else None
+        kind = (raw.get(cols["type"]) or "").strip().lower() if cols["type"] else ""
+        if amount is None and (cols["debit"] or cols["credit"]):
+            debit = parse_amount(raw.get(cols["debit"])) if cols["debit"] else None
+            credit = parse_amount(raw.get(cols["credit"])) if cols["credit"] else None
+            amount = debit or credit
+            if kind not in ("expense", "income"):
+                kind = "expense" if debit else "income"
+        if when is None or not amount:
+            yield None
+            continue
+        if kind not in ("expense", "income"):
+            kind = "income" if amount > 0 and positive_is_income else "expense"
+        category = (raw.get(cols["category"]) or "").strip() if cols["category"] else ""
+        yield {
+            "type": kind,
+            "date": when,
+            "amount": abs(amount),
+            "item": item or "Imported",
+            "category": category if category in CATEGORIES else None,
+        }
+
+
+def _existing_fingerprints(snap):
+    """Stored rows per fingerprint; two identical coffees count twice"""
+    seen = Counter()
+    if snap is None:
+        return seen
+    for i in range(snap.size):
+        seen[row_fingerprint(_iso_date(snap.ts[i]), snap.amount[i], snap.items[i])] += 1
+        if snap.kind[i] == EXPENSE and snap.items[i]:
+            remember_category(snap.items[i], snap.categories[snap.cat[i]])
+    return seen
+
+
+def _insert_chunk(user_id, chunk):
+    expense_items = [
+        t["item"] for t in chunk if t["type"] == "expense" and not t["category"]
+    ]
+    categories = batch_categorization(expense_items) if expense_items else {}
+    expenses, income = [], []
+    for t in chunk:
+        created_at = t["date"].replace(tzinfo=t["date"].tzinfo or timezone.utc)
+        if t["type"] == "expense":
+            t["category"] = t["category"] or categories.get(t["item"], "Misc")
+            expenses.append(
+                {
+                    "user_id": user_id,
+                    "item": t["item"],
+                    "amount": t["amount"],
+                    "category": t["category"],
+                    "created_at": created_at.isoformat(),
+                }
+            )
+        else:
+            income.append(
+                {
+                    "user_id": user_id,
+                    "amount": t["amount"],
+                    "source": t["item"],
+                    "created_at": created_at.isoformat(),
+                }
+            )
+    for table, kind, rows in (
+        ("expenses", EXPENSE, expenses),
+        ("income", INCOME, income),
+    ):
+        if not rows:
+            continue
+        if not store.insert_many(table, user_id, rows):
+            return False
+        # Keep the snapshot (and so the dedup set of a re-run) in step
+        for r in rows:
+            snapshot_append(
+                user_id,
+                kind,
+                r["amount"],
+                r.get("category"),
+                r.get("item") or r.get("source"),
+                to_epoch(r["created_at"]),
+            )
+    return True
+
+
+def import_statement(user_id, lines, positive_is_income=False, skip=0, chunk_size=None):
+    """Generator of progress dicts; the last one has done=True"""
+    chunk_size = chunk_size or IMPORT_CHUNK_SIZE
+    seen = _existing_fingerprints(get_snapshot(user_id))
+    progress = {
+        "rows": 0,
+        "inserted": 0,
+        "duplicates": 0,
+        "invalid": 0,
+        "chunks": 0,
+        "resume_skip": skip,
+    }
+    chunk = []
+
+    def flush():
+        if not _insert_chunk(user_id, chunk):
+            raise RuntimeError(
+                f"Insert failed; resume with skip={progress['resume_skip']}"
+            )
+        progress["inserted"] += len(chunk)
+        progress["chunks"] += 1
+        progress["resume_skip"] = progress["rows"]
+        chunk.clear()
+
+    try:
+        for row in iter_statement_rows(lines, positive_is_income):
+            progress["rows"] += 1
+            fp = row and row_fingerprint(
+                row["date"].strftime("%Y-%m-%d"), row["amount"], row["item"]
+            )
+            # Each stored row matches at most one file row, so repeated lines
+            # in the file still import; rows skipped on resume were stored by
+            # the earlier run and use up their match too.
+            stored = fp is not None and seen[fp] > 0
+            if stored:
+                seen[fp] -= 1
+            if progress["rows"] <= skip:
+                continue
+            if row is None:
+                progress["invalid"] += 1
+                continue
+            if stored:
+                progress["duplicates"] += 1
+                continue
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                flush()
+                yield dict(progress)
+        if chunk:
+            flush()
+        progress["resume_skip"] = progress["rows"]
+        yield dict(progress, done=True)
+    except Exception as e:
+        yield dict(progress, done=True, error=str(e))
+    finally:
+        if progress["inserted"]:
+            bump_data_version(user_id)
+            budget_watcher.reset(user_id)
+
+
+# --- EXPORT ---
+# Full-ledger export paged by keyset on (created_at, id): each page is an
+# index range scan after the last row seen, so deep pages cost the same as
+# the first one, and only one page is held in memory at a time.
+EXPORT_COLUMNS = {
+    "expenses": ("id", "created_at", "item", "category", "amount"),
+    "income": ("id", "created_at", "source", "description", "amount"),
+}
+
+
+def iter_ledger(user_id, table, start=None, end=None, page_size=None):
+    page_size = page_size or EXPORT_PAGE_SIZE
+    cursor = None
+    while True:
+        page = store.ledger_page(
+            table, user_id, EXPORT_COLUMNS[table], start, end, cursor, page_size
+        )
+        if page is None:
+            raise RuntimeError(f"Export of {table} failed after {cursor}")
+        yield from page
+        if len(page) < page_size:
+            return
+        cursor = (page[-1]["created_at"], page[-1]["id"])
+
+
+def export_lines(user_id, table, fmt="csv", start=None, end=None):
+    """Yield CSV or NDJSON text one page at a time"""
+    columns = EXPORT_COLUMNS[table]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        writer.writerow(columns)
+    count = 0
+    try:
+        for row in iter_ledger(user_id, table, start, end):
+            if fmt == "csv":
+                writer.writerow([row.get(c) for c in columns])
+            else:
+                buf.write(json.dumps(row) + "\n")
+            count += 1
+            if count % EXPORT_PAGE_SIZE == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+    except RuntimeError as e:
+        # Headers are already sent; make the truncation visible in the body
+        print(f"Export error: {e}")
+        buf.write(
+            f"# export failed: {e}\n"
+            if fmt == "csv"
+            else json.dumps({"error": str(e)}) + "\n"
+        )
+    yield buf.getvalue()
+
+
+# --- SUBSCRIPTION BILLING ---
+# Active subscriptions are turned into expenses when due, by a scheduled job
+# (Vercel cron -> /api/cron/billing, or "python api/index.py bill"). Every
+# charge carries a billing_key unique per (subscription, due date), so runs
+# are idempotent. The month-end forecast adds charges still due this month
+# to the snapshot's month-to-date totals.
+SUBSCRIPTION_CATEGORY = "Subscriptions"
+BILLING_STEPS = {"weekly": (7, 0), "monthly": (0, 1), "yearly": (0, 12)}
+
+
+def add_months(dt, months):
+    month_index = dt.month - 1 + months
+    year, month = dt.year + month_index // 12, month_index % 12 + 1
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    last_day = (next_month - timedelta(days=1)).day
+    return dt.replace(year=year, month=month, day=min(dt.day, last_day))
+
+
+def billing_date(anchor, cycle, n):
+    """n-th charge after anchor; computed from the anchor so month ends don't drift"""
+    days, months = BILLING_STEPS.get(cycle, BILLING_STEPS["monthly"])
+    return add_months(anchor, n * months) + timedelta(days=n * days)
+
+
+def billing_key(subscription_id, due_at):
+    return f"sub:{subscription_id}:{due_at.strftime('%Y-%m-%d')}"
+
+
+def _as_utc(value):
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def billing_cycles(anchor, at, cycle):
+    """Whole cycles from anchor to at, give or take one (mirrors setup.sql)"""
+    if cycle == "weekly":
+        return (at - anchor).days // 7
+    if cycle == "yearly":
+        return at.year - anchor.year
+    return (at.year - anchor.year) * 12 + at.month - anchor.month
+
+
+def due_charges(sub, until, since=None):
+    """Charge dates from the next_billing_at cursor (or since, if later) up to
+    until, and the first charge after them. Dates always count from
+    created_at, so the cursor never shifts the day of month."""
+    anchor = _as_utc(sub["created_at"])
+    cycle = sub.get("billing_cycle")
+    start = _as_utc(sub.get("next_billing_at") or sub["created_at"])
+    if since is not None:
+        start = max(start, _as_utc(since))
+    until = _as_utc(until)
+    n = max(billing_cycles(anchor, start, cycle) - 1, 0)
+    while billing_date(anchor, cycle, n) < start:
+        n += 1
+    due = []
+    while billing_date(anchor, cycle, n) <= until:
+        due.append(billing_date(anchor, cycle, n))
+        n += 1
+    return due, billing_date(anchor, cycle, n)
+
+
+def run_billing(now=None):
+    """Materialize all due charges in one pass; returns a summary"""
+    now = _as_utc(now or datetime.now(timezone.utc))
+    charges = store.materialize_charges(now)
+    if charges is None:
+        return {"success": False, "error": "Billing run failed"}
+    users = set()
+    for c in charges:
+        users.add(c["user_id"])
+        snapshot_append(
+            c["user_id"],
+            EXPENSE,
+            float(c["amount"]),
+            SUBSCRIPTION_CATEGORY,
+            c["item"],
+            to_epoch(c["created_at"]),
+        )
+    for user_id in users:
+        bump_data_version(user_id)
+        budget_watcher.reset(user_id)
+    return {"success": True, "charged": len(charges), "users": len(users)}
+
+
+_subscriptions_cache = {}
+
+
+def active_subscriptions_cached(user_id):
+    """Active subscriptions, refetched after this user's data changes here or
+    SUBSCRIPTIONS_CACHE_TTL seconds, whichever comes first"""
+    version = data_version(user_id)
+    cached = _subscriptions_cache.get(user_id)
+    if (
+        cached
+        and cached[0] == version
+        and time.monotonic() - cached[1] < SUBSCRIPTIONS_CACHE_TTL
+    ):
+        return cached[2]
+    subs = store.active_subscriptions(user_id)
+    if subs is None:
+        return []
+    _subscriptions_cache[user_id] = (version, time.monotonic(), subs)
+    return subs
+
+
+def forecast_month_end(user_id, snap=None, now=None):
+    now = _as_utc(now or datetime.now(timezone.utc))
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    month_end = add_months(month_start, 1)
+    snap = snap or get_snapshot(user_id)
+    spent = snap.totals(month_start, now)["expenses"] if snap else 0.0
+    upcoming = []
+    for sub in active_subscriptions_cached(user_id):
+        if not sub.get("created_at"):
+            continue
+        due, _ = due_charges(sub, month_end - timedelta(microseconds=1))
+        for due_at in due:
+            if due_at > now:
+                upcoming.append(
+                    {
+                        "name": sub["name"],
+                        "amount": float(sub.get("amount") or 0),
+                        "date": due_at.strftime("%Y-%m-%d"),
+                    }
+                )
+    upcoming_total = sum(u["amount"] for u in upcoming)
+    return {
+        "month_to_date": round(spent, 2),
+        "upcoming_subscriptions": round(upcoming_total, 2),
+        "upcoming": upcoming,
+        "projected_month_end": round(spent + upcoming_total, 2),
+    }
+
+
+# --- BUDGET WATCHER ---
+# Running month-to-date spend and per-category mean/variance (Welford, over
+# all of the user's expenses), seeded from the snapshot and then updated in
+# O(1) per logged expense, so budget and outlier checks never re-query
+# history. Bulk writes (imports, billing runs) just drop the user's state
+# and it is re-seeded lazily. The state remembers how many expense rows it
+# has seen; when the ledger counts show rows written by another instance it
+# is re-seeded, and thresholds those rows crossed count as already fired.
+class BudgetWatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+
+    def _seed(self, user_id, now, amount, category):
+        snap = get_snapshot(user_id)
+        if snap is None:
+            return None
+        profile = store.get_profile(user_id) or {}
+        month = now.strftime("%Y-%m")
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        spent = snap.totals(month_start, now)["expenses"]
+        idx = snap.select(EXPENSE)
+        cats = snap.cat[idx]
+        amounts = snap.amount[idx]
+        ncat = len(snap.categories)
+        count = np.bincount(cats, minlength=ncat)
+        total = np.bincount(cats, weights=amounts, minlength=ncat)
+        squares = np.bincount(cats, weights=amounts * amounts, minlength=ncat)
+        stats = {}
+        for c in np.flatnonzero(count):
+            n = int(count[c])
+            mean = float(total[c]) / n
+            m2 = max(0.0, float(squares[c]) - n * mean * mean)
+            stats[snap.categories[c]] = [n, mean, m2]
+        # The snapshot already holds the expense being observed: back it out
+        # so the seed is the state before this write and observe() can fold
+        # it in (and alert on it) like any other expense
+        spent -= amount
+        n, mean, m2 = stats.pop(category, (0, 0.0, 0.0))
+        if n > 1:
+            prev = (n * mean - amount) / (n - 1)
+            stats[category] = [
+                n - 1,
+                prev,
+                max(0.0, m2 - (amount - prev) * (amount - mean)),
+            ]
+        budget = float(profile.get("budget") or 0)
+        state = {
+            "month": month,
+            "spent": spent,
+            "budget": budget,
+            # Thresholds crossed before this write are not re-announced
+            "fired": {
+                t for t in BUDGET_ALERT_THRESHOLDS if budget and spent >= budget * t
+            },
+            "stats": stats,
+            # Expense rows behind this state, the new one not included
+            "expenses": snap.counts[EXPENSE] - 1,
+        }
+        METRICS["watcher"]["seeds"] += 1
+        return state
+
+    def reset(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def observe(self, user_id, amount, category, item="", now=None):
+        """Fold one new expense into the running stats; returns alert texts"""
+        now = _as_utc(now or datetime.now(timezone.utc))
+        with self._lock:
+            state = self._users.get(user_id)
+        if state is not None:
+            counts = ledger_counts(user_id)
+            if counts and counts[EXPENSE] != state["expenses"] + 1:
+                METRICS["watcher"]["reseeds"] += 1
+                state = None
+        if state is None:
+            state = self._seed(user_id, now, amount, category)
+            if state is None:
+                return []
+            with self._lock:
+                self._users[user_id] = state
+        alerts = []
+        with self._lock:
+            METRICS["watcher"]["updates"] += 1
+            month = now.strftime("%Y-%m")
+            if state["month"] != month:
+                state.update(month=month, spent=0.0, fired=set())
+            n, mean, m2 = state["stats"].get(category, (0, 0.0, 0.0))
+            if n >= ANOMALY_MIN_SAMPLES and m2 > 0:
+                std = (m2 / (n - 1)) ** 0.5
+                z = (amount - mean) / std
+                if z >= ANOMALY_Z:
+                    METRICS["watcher"]["anomaly_alerts"] += 1
+                    alerts.append(
+                        f"Unusual expense: {amount:.2f} MDL on {item or category} is "
+                        f"{z:.1f} standard deviations above your usual "
+                        f"{category} spend ({mean:.2f} MDL)."
+                    )
+            n += 1
+            delta = amount - mean
+            mean += delta / n
+            m2 += delta * (amount - mean)
+            state["stats"][category] = [n, mean, m2]
+            state["spent"] += amount
+            state["expenses"] += 1
+            budget = state["budget"]
+            crossed = [
+                t
+                for t in BUDGET_ALERT_THRESHOLDS
+                if budget and t not in state["fired"] and state["spent"] >= budget * t
+            ]
+            if crossed:
+                state["fired"].update(crossed)
+                METRICS["watcher"]["budget_alerts"] += 1
+                alerts.append(
+                    f"Budget alert: {state['spent']:.2f} of {budget:.2f} MDL spent "
+                    f"this month ({state['spent'] / budget:.0%})."
+                )
+        return alerts
+
+
+budget_watcher = BudgetWatcher()
+
+
+def send_alerts(user_id, alerts):
+    """Push alerts to the user's private Telegram chat (chat id == user id)"""
+    for text in alerts:
+        try:
+            bot.send_message(user_id, text)
+        except Exception as e:
+            METRICS["watcher"]["send_failures"] += 1
+            print(f"Alert error: {e}")
+
+
+# --- CHAT HISTORY WRITE-BEHIND ---
+# chat_history rows never affect the reply being built, so they are queued
+# and written as one array insert. A flush happens when HISTORY_BATCH_SIZE
+# rows are waiting, every HISTORY_FLUSH_INTERVAL seconds, after a request has
+# been answered, and at shutdown. The backlog is bounded: if Supabase is
+# down the oldest rows are dropped rather than growing memory forever.
+HISTORY_COLUMNS = ("user_id", "role", "content", "tool_calls", "tool_results")
+
+
+class WriteBehindBuffer:
+    def __init__(self, table, stats):
+        self.table = table
+        self.stats = stats
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            self.stats["queued"] += 1
+            overflow = len(self._rows) - HISTORY_MAX_BACKLOG
+            if overflow > 0:
+                del self._rows[:overflow]
+                self.stats["dropped"] += overflow
+            full = len(self._rows) >= HISTORY_BATCH_SIZE
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def pending(self, user_id):
+        with self._lock:
+            return [r for r in self._rows if r["user_id"] == user_id]
+
+    def backlog(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._rows = self._rows, []
+            # RLS checks rows against the user's JWT, so insert per user
+            by_user = OrderedDict()
+            for row in batch:
+                by_user.setdefault(row["user_id"], []).append(row)
+            failed = []
+            for user_id, rows in by_user.items():
+                if store.insert_many(self.table, user_id, rows):
+                    self.stats["flushed"] += len(rows)
+                    self.stats["batches"] += 1
+                else:
+                    self.stats["failures"] += 1
+                    failed.extend(rows)
+            if failed:
+                with self._lock:
+                    # Put failed rows back in front, still honouring the bound
+                    rows = failed + self._rows
+                    overflow = max(0, len(rows) - HISTORY_MAX_BACKLOG)
+                    self._rows = rows[overflow:]
+                    self.stats["dropped"] += overflow
+            return not failed
+
+    def _ensure_thread(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(HISTORY_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"History flush error: {e}")
+
+
+history_buffer = WriteBehindBuffer("chat_history", METRICS["chat_history"])
+atexit.register(history_buffer.flush)
+
+
+def record_history(user_id, role, content, tool_calls=None, tool_results=None):
+    # Array inserts need identical keys in every row; created_at is stamped
+    # now so order reflects the conversation, not the flush time.
+    history_buffer.add(
+        {
+            "user_id": user_id,
+            "role": role,
+            "content": content,
+            "tool_calls": tool_calls,
+            "tool_results": tool_results,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+    )
+
+
+# --- TOOL RESULT COMPACTION ---
+# Tool results go back into the second completion and into
+# chat_history.tool_results, so they are shrunk first: ids and billing keys
+# are dropped, timestamps cut to dates, amounts rounded, lists of
+# rows sent as columns + rows, and long lists reduced to per-column summary
+# stats plus TOOL_RESULT_TOP_N rows: the first ones (tools order rows newest
+# or best match first), or the latest buckets of a time series. The top-N
+# shrinks until the result fits TOOL_RESULT_MAX_TOKENS.
+COMPACT_DROP_KEYS = {"id", "user_id", "billing_key"}
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token); no tokenizer needed"""
+    return (len(text) + 3) // 4
+
+
+def _compact(value, top_n):
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            if k in COMPACT_DROP_KEYS or v is None:
+                continue
+            if isinstance(v, str) and (k.endswith("_at") or k == "deadline"):
+                v = v[:10]
+            out["date" if k == "created_at" else k] = _compact(v, top_n)
+        return out
+    if isinstance(value, list):
+        if value and all(isinstance(v, dict) for v in value):
+            return _compact_rows([_compact(v, top_n) for v in value], top_n)
+        return [_compact(v, top_n) for v in value]
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+def _compact_rows(rows, top_n):
+    columns = []
+    for r in rows:
+        columns.extend(k for k in r if k not in columns)
+    # Time series come oldest first; their latest buckets matter most
+    kept = rows[-top_n:] if "bucket" in columns else rows[:top_n]
+    table = {
+        "columns": columns,
+        "rows": [[r.get(c) for c in columns] for r in kept],
     }
-    try:
-        if method == "GET":
-            return requests.get(url, headers=headers, params=params)
-        elif method == "POST":
-            return requests.post(url, headers=headers, json=json_body, params=params)
-        elif method == "PATCH":
-            return requests.patch(url, headers=headers, json=json_body, params=params)
-        elif method == "DELETE":
-            return requests.delete(url, headers=headers, params=params)
-    except Exception as e:
-        print(f"Supabase error: {e}")
-        return None
+    if len(rows) > top_n:
+        table["total_rows"] = len(rows)
+        stats = {}
+        for c in columns:
+            values = [r[c] for r in rows if r.get(c) is not None]
+            if values and all(
+                isinstance(v, (int, float)) and not isinstance(v, bool) for v in values
+            ):
+                stats[c] = {
+                    "sum": round(sum(values), 2),
+                    "min": min(values),
+                    "max": max(values),
+                    "avg": round(sum(values) / len(values), 2),
+                }
+        if stats:
+            table["stats"] = stats
+        if "category" in columns:
+            by_category = {}
+            for r in rows:
+                if isinstance(r.get("amount"), (int, float)):
+                    cat = r.get("category") or "Misc"
+                    by_category[cat] = round(by_category.get(cat, 0) + r["amount"], 2)
+            table["by_category"] = by_category
+    return table
 
 
-# --- CATEGORIZATION ---
-def strict_categorization(item_text):
-    if not GROQ_API_KEY:
-        return "Misc"
-    categories_str = ", ".join(CATEGORIES)
-    prompt = f"""Categorize this expense into EXACTLY ONE of these categories: {categories_str}.
-Output ONLY the category name, nothing else.
-Expense: "{item_text}"
-Category:"""
-    try:
-        response = groq_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            model="llama-3.3-70b-versatile",
-            temperature=0.3,
-        )
-        result = response.choices[0].message.content.strip()
-        for cat in CATEGORIES:
-            if cat.lower() in result.lower():
-                return cat
-        return "Misc"
-    except Exception as e:
-        print(f"Categorization error: {e}")
-        return "Misc"
+def _compact_json(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=str)
 
 
-# --- RESPONSE SANITIZER ---
-def sanitize_response(text):
-    """Strip any raw function tags or XML-like function calls from response"""
-    if not text:
-        return ""
-    text = re.sub(r"<function=[^>]*>", "", text)
-    text = re.sub(r"</function>", "", text)
-    text = re.sub(r"\\[function:[^\\]*\\]", "", text)
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+def compact_tool_result(result):
+    """(compact object, its JSON text) for a tool result, within the token cap"""
+    tokens_in = estimate_tokens(json.dumps(result, default=str))
+    top_n = TOOL_RESULT_TOP_N
+    while True:
+        compact = _compact(result, top_n)
+        text = _compact_json(compact)
+        if estimate_tokens(text) <= TOOL_RESULT_MAX_TOKENS or top_n <= 1:
+            break
+        top_n //= 2
+    stats = METRICS["tool_results"]
+    if estimate_tokens(text) > TOOL_RESULT_MAX_TOKENS:
+        # Still too big (wide nested results): hand over a cut-off preview
+        stats["truncated"] += 1
+        preview = text[: TOOL_RESULT_MAX_TOKENS * 4]
+        while True:
+            compact = {"truncated": True, "preview": preview}
+            text = _compact_json(compact)
+            if estimate_tokens(text) <= TOOL_RESULT_MAX_TOKENS or not preview:
+                break
+            # Quotes are escaped inside the preview, so trim and re-measure
+            preview = preview[: len(preview) * 9 // 10]
+    stats["results"] += 1
+    stats["tokens_in"] += tokens_in
+    stats["tokens_out"] += estimate_tokens(text)
+    return compact, text
 
 
 # === TOOL DEFINITIONS ===
@@ -139,7 +2678,7 @@ TOOLS = [
                     },
                     "filter_item": {
                         "type": "string",
-                        "description": "Partial match on item name",
+                        "description": "Fuzzy match on item name (typos and spacing are tolerated)",
                     },
                     "category": {
                         "type": "string",
@@ -229,31 +2768,74 @@ TOOLS = [
             },
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "tool_get_timeseries",
+            "description": "Income, expenses and net per day, week or month, for trend questions.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "granularity": {
+                        "type": "string",
+                        "enum": ["day", "week", "month"],
+                    },
+                    "start_date": {
+                        "type": "string",
+                        "description": "ISO date YYYY-MM-DD",
+                    },
+                    "end_date": {
+                        "type": "string",
+                        "description": "ISO date YYYY-MM-DD",
+                    },
+                    "by_category": {
+                        "type": "boolean",
+                        "description": "Also split expenses per category",
+                    },
+                },
+                "required": ["granularity"],
+            },
+        },
+    },
 ]
 
 
+# Tools that write data; a turn that calls any of these is never cached
+MUTATING_TOOLS = {
+    "tool_log_transaction",
+    "tool_manage_subscription",
+    "tool_update_savings",
+}
+
+
 # === TOOL IMPLEMENTATIONS ===
-def tool_log_transaction(type, amount, item, category=None):
+def tool_log_transaction(type, amount, item, category=None, *, user_id):
     if type == "expense":
         if not category:
             category = strict_categorization(item)
-        data = {"item": item, "amount": float(amount), "category": category}
-        resp = supabase_request("expenses", method="POST", json_body=data)
-        success = resp and resp.status_code in (200, 201)
+        success = store.insert_expense(user_id, item, float(amount), category)
+        if success:
+            snapshot_append(user_id, EXPENSE, float(amount), category, item)
+            send_alerts(
+                user_id,
+                budget_watcher.observe(user_id, float(amount), category, item),
+            )
         message = (
             f"Logged expense: {amount} on {item} ({category})"
             if success
             else "Failed to log expense"
         )
     else:
-        data = {"amount": float(amount), "source": item}
-        resp = supabase_request("income", method="POST", json_body=data)
-        success = resp and resp.status_code in (200, 201)
+        success = store.insert_income(user_id, float(amount), item)
+        if success:
+            snapshot_append(user_id, INCOME, float(amount), item=item)
         message = (
             f"Logged income: {amount} from {item}"
             if success
             else "Failed to log income"
         )
+    if success:
+        bump_data_version(user_id)
     return {"success": success, "message": message}
 
 
@@ -264,64 +2846,68 @@ def tool_get_analytics(
     start_date=None,
     end_date=None,
     limit=10,
+    *,
+    user_id,
 ):
-    filters = []
-    if start_date:
-        filters.append(f"created_at=gte.{start_date}")
-    if end_date:
-        filters.append(f"created_at=lte.{end_date}")
-    filter_str = "&".join(filters) if filters else ""
-    endpoint = f"{table}?select=*"
-    if filter_str:
-        endpoint += f"&{filter_str}"
-    endpoint += f"&limit={limit}"
-    resp = supabase_request(endpoint)
-    if not resp or resp.status_code != 200:
+    if table in ("expenses", "income") and filter_item:
+        # Every match counts toward the total; the best ones are listed
+        matches = search_transactions(
+            user_id, filter_item, table, start_date, end_date, category, limit=None
+        )
+        if matches is None:
+            return {"success": False, "error": "Query failed"}
+        total = sum(m["amount"] for m in matches)
+        return {
+            "success": True,
+            "data": matches[: limit or 10],
+            "count": len(matches),
+            "total": total,
+        }
+    if table in ("expenses", "income"):
+        snap = get_snapshot(user_id)
+        if snap is None:
+            return {"success": False, "error": "Query failed"}
+        kind = EXPENSE if table == "expenses" else INCOME
+        idx = snap.select(kind, start_date, end_date, category)
+        total = float(snap.amount[idx].sum())
+        results = snap.rows(idx[::-1][: limit or 10])
+        return {"success": True, "data": results, "count": len(idx), "total": total}
+    results = store.query_subscriptions(user_id, start_date, end_date, limit)
+    if results is None:
         return {"success": False, "error": "Query failed"}
-    results = resp.json()
     if filter_item:
-        results = [
-            r
-            for r in results
-            if filter_item.lower() in r.get("item", "").lower()
-            or filter_item.lower() in r.get("source", "").lower()
-        ]
+        index = TrigramIndex()
+        for r in results:
+            index.add(r.get("name", ""))
+        scores = index.match(filter_item)
+        results = [r for r in results if index.keys[r.get("name", "")] in scores]
     if category:
         results = [r for r in results if r.get("category") == category]
     total = sum(float(r.get("amount", 0)) for r in results)
     return {"success": True, "data": results, "count": len(results), "total": total}
 
 
-def tool_manage_subscription(action, name, amount=None, billing_cycle="monthly"):
+def tool_manage_subscription(
+    action, name, amount=None, billing_cycle="monthly", *, user_id
+):
     if action == "cancel":
-        resp = supabase_request(
-            f"subscriptions?name=eq.{name}",
-            method="PATCH",
-            json_body={"is_active": False},
-        )
-        success = resp and resp.status_code in (200, 201)
+        success = store.update_subscription(user_id, name, {"is_active": False})
         message = f"Cancelled subscription: {name}"
     elif action == "update":
         data = {"amount": float(amount), "billing_cycle": billing_cycle}
-        resp = supabase_request(
-            f"subscriptions?name=eq.{name}", method="PATCH", json_body=data
-        )
-        success = resp and resp.status_code in (200, 201)
+        success = store.update_subscription(user_id, name, data)
         message = f"Updated subscription: {name}"
     else:
-        data = {
-            "name": name,
-            "amount": float(amount) if amount else 0,
-            "billing_cycle": billing_cycle,
-            "is_active": True,
-        }
-        resp = supabase_request("subscriptions", method="POST", json_body=data)
-        success = resp and resp.status_code in (200, 201)
+        success = store.add_subscription(
+            user_id, name, float(amount) if amount else 0, billing_cycle
+        )
         message = f"Added subscription: {name}"
+    if success:
+        bump_data_version(user_id)
     return {"success": success, "action": action, "name": name, "message": message}
 
 
-def tool_get_summary(period="this_month"):
+def tool_get_summary(period="this_month", *, user_id):
     now = datetime.now()
     periods = {
         "today": (
@@ -329,7 +2915,7 @@ def tool_get_summary(period="this_month"):
             now.isoformat(),
         ),
         "this_week": (
-            (now - datetime.timedelta(days=now.weekday()))
+            (now - timedelta(days=now.weekday()))
             .replace(hour=0, minute=0, second=0, microsecond=0)
             .isoformat(),
             now.isoformat(),
@@ -339,7 +2925,7 @@ def tool_get_summary(period="this_month"):
             now.isoformat(),
         ),
         "last_month": (
-            (now.replace(day=1) - datetime.timedelta(days=1))
+            (now.replace(day=1) - timedelta(days=1))
             .replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             .isoformat(),
             now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat(),
@@ -353,43 +2939,31 @@ def tool_get_summary(period="this_month"):
         "all_time": ("2020-01-01T00:00:00", now.isoformat()),
     }
     start, end = periods.get(period, periods["this_month"])
-    exp_resp = supabase_request(
-        f"expenses?created_at=gte.{start}&created_at=lte.{end}&select=amount,category"
-    )
-    exp_total = 0
-    exp_by_cat = {}
-    if exp_resp and exp_resp.status_code == 200:
-        for e in exp_resp.json():
-            amt = float(e.get("amount", 0))
-            exp_total += amt
-            cat = e.get("category", "Misc")
-            exp_by_cat[cat] = exp_by_cat.get(cat, 0) + amt
-    inc_resp = supabase_request(
-        f"income?created_at=gte.{start}&created_at=lte.{end}&select=amount"
-    )
-    inc_total = 0
-    if inc_resp and inc_resp.status_code == 200:
-        for i in inc_resp.json():
-            inc_total += float(i.get("amount", 0))
-    return {
+    snap = get_snapshot(user_id)
+    if snap is None:
+        return {"success": False, "error": "Query failed"}
+    totals = snap.totals(start, end)
+    summary = {
         "success": True,
-        "income": inc_total,
-        "expenses": exp_total,
-        "net": inc_total - exp_total,
+        "income": totals["income"],
+        "expenses": totals["expenses"],
+        "net": totals["net"],
+        "by_category": snap.by_category(start, end),
     }
+    if period == "this_month":
+        summary["forecast"] = forecast_month_end(user_id, snap)
+    return summary
 
 
-def tool_update_savings(goal_name, amount=None, action="add"):
-    check = supabase_request(f"savings_goals?name=eq.{goal_name}")
-    if not check or not check.json():
+def tool_update_savings(goal_name, amount=None, action="add", *, user_id):
+    goal = store.get_goal(user_id, goal_name)
+    if not goal:
         target = amount if action == "set_target" else (amount or 1000)
         current = 0 if action in ["create", "set_target"] else (amount or 0)
-        data = {"name": goal_name, "target_amount": target, "current_amount": current}
-        resp = supabase_request("savings_goals", method="POST", json_body=data)
-        success = resp and resp.status_code in (200, 201)
+        data = {"target_amount": target, "current_amount": current}
+        success = store.insert_goal(user_id, goal_name, data)
         message = f"Created savings goal: {goal_name}"
     else:
-        goal = check.json()[0]
         if action == "add":
             new_amount = goal["current_amount"] + (amount or 0)
             data = {"current_amount": new_amount}
@@ -397,29 +2971,38 @@ def tool_update_savings(goal_name, amount=None, action="add"):
         else:
             data = {"target_amount": amount}
             message = f"Set target for {goal_name}"
-        resp = supabase_request(
-            f"savings_goals?id=eq.{goal['id']}", method="PATCH", json_body=data
-        )
-        success = resp and resp.status_code in (200, 201)
+        success = store.update_goal(user_id, goal["id"], data)
+    if success:
+        bump_data_version(user_id)
     return {"success": success, "goal": goal_name, "action": action, "message": message}
 
 
-# === AGENT LOOP ===
-def agent_process_message(
-    user_message: str, user_id: int = 1, chat_history: list = None
+def tool_get_timeseries(
+    granularity="month", start_date=None, end_date=None, by_category=False, *, user_id
 ):
+    series = get_timeseries(user_id, granularity, start_date, end_date, by_category)
+    if series is None:
+        return {"success": False, "error": "Query failed"}
+    return {"success": True, "granularity": granularity, "series": series}
+
+
+# === AGENT LOOP ===
+def _agent_steps(user_message, user_id):
     """Atomic agent loop - tool calls MUST complete before response"""
     CURRENT_DATE = "2026-02-06"
-    profile_resp = supabase_request(f"financial_profile?user_id=eq.{user_id}")
-    profile = (
-        profile_resp.json()[0]
-        if profile_resp and profile_resp.json()
-        else {"budget": 5000, "goals": "Save money"}
-    )
-    history_resp = supabase_request(
-        f"chat_history?user_id=eq.{user_id}&order=created_at.desc&limit=10"
-    )
-    history = history_resp.json()[::-1] if history_resp and history_resp.json() else []
+    # data_version() may probe the store, so it runs as an effect too
+    version = yield ("tool", data_version, {"user_id": user_id})
+    cache_key = response_cache_key(user_id, user_message, version)
+    cached = response_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    profile = (yield ("store", "get_profile", user_id)) or {
+        "budget": 5000,
+        "goals": "Save money",
+    }
+    history = ((yield ("store", "recent_history", user_id, 10)) or [])[::-1]
+    # Rows still waiting in the write-behind buffer are the most recent ones
+    history = (history + history_buffer.pending(user_id))[-10:]
     system_prompt = f"""You are ContabilBOT, a witty, sarcastic AI CFO.
 
 Your personality:
@@ -443,13 +3026,13 @@ CRITICAL RULE: If you need to call a tool, do NOT respond yet. Call the tool, ge
         messages.append({"role": h["role"], "content": h["content"]})
     messages.append({"role": "user", "content": user_message})
     try:
-        response = groq_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto",
-            temperature=0.7,
+        response = yield (
+            "llm",
+            messages,
+            {"tools": TOOLS, "tool_choice": "auto", "temperature": 0.7},
         )
+    except GroqUnavailable:
+        return "My brain is offline right now (Groq is down). Try again in a minute."
     except Exception as e:
         return f"Oops, my brain hiccuped: {str(e)}"
     response_message = response.choices[0].message
@@ -459,10 +3042,12 @@ CRITICAL RULE: If you need to call a tool, do NOT respond yet. Call the tool, ge
         for call in tool_calls:
             func_name = call.function.name
             func_args = json.loads(call.function.arguments)
+            # The acting user always comes from the request, never the model
+            func_args.pop("user_id", None)
             func = globals().get(func_name)
             if func:
                 try:
-                    result = func(**func_args)
+                    result = yield ("tool", func, dict(func_args, user_id=user_id))
                 except Exception as e:
                     result = {"success": False, "error": str(e)}
             else:
@@ -470,142 +3055,311 @@ CRITICAL RULE: If you need to call a tool, do NOT respond yet. Call the tool, ge
             tool_results.append(
                 {"tool": func_name, "arguments": func_args, "result": result}
             )
-        supabase_request(
-            "chat_history",
-            method="POST",
-            json_body={"user_id": user_id, "role": "user", "content": user_message},
-        )
+        record_history(user_id, "user", user_message)
         messages.append(response_message)
+        compact_results = []
         for i, result in enumerate(tool_results):
+            compact, text = compact_tool_result(result["result"])
+            compact_results.append(dict(result, result=compact))
             messages.append(
-                {
-                    "role": "tool",
-                    "tool_call_id": tool_calls[i].id,
-                    "content": json.dumps(result["result"]),
-                }
+                {"role": "tool", "tool_call_id": tool_calls[i].id, "content": text}
             )
         try:
-            final_response = groq_client.chat.completions.create(
-                model="llama-3.3-70b-versatile", messages=messages, temperature=0.8
-            )
+            final_response = yield ("llm", messages, {"temperature": 0.8})
             final_content = sanitize_response(
                 final_response.choices[0].message.content or ""
             )
+            cacheable = bool(final_content)
         except Exception as e:
             final_content = f"I got the data but failed to generate response: {str(e)}"
-        supabase_request(
-            "chat_history",
-            method="POST",
-            json_body={
-                "user_id": user_id,
-                "role": "assistant",
-                "content": final_content,
-                "tool_calls": json.dumps([tc.function.name for tc in tool_calls]),
-                "tool_results": json.dumps(tool_results),
-            },
+            cacheable = False
+        record_history(
+            user_id,
+            "assistant",
+            final_content,
+            tool_calls=json.dumps([tc.function.name for tc in tool_calls]),
+            tool_results=_compact_json(compact_results),
+        )
+        cacheable = cacheable and all(
+            r["tool"] not in MUTATING_TOOLS and r["result"].get("success")
+            for r in tool_results
         )
+        if cacheable:
+            response_cache_put(cache_key, final_content)
         return final_content
     else:
         content = (
             sanitize_response(response_message.content)
             or "I didn't understand. Try rephrasing?"
         )
-        supabase_request(
-            "chat_history",
-            method="POST",
-            json_body={"user_id": user_id, "role": "assistant", "content": content},
-        )
+        record_history(user_id, "assistant", content)
         return content
 
 
+def agent_process_message(user_message: str, user_id: int, chat_history: list = None):
+    return drive(
+        _agent_steps(user_message, user_id),
+        {
+            "store": lambda name, *args: getattr(store, name)(*args),
+            "llm": lambda messages, kwargs: groq_chat(messages, **kwargs),
+            "tool": lambda func, kwargs: func(**kwargs),
+        },
+    )
+
+
+async def _store_async(name, *args):
+    # Supabase reads go through the shared AsyncClient; anything else
+    # (SQLite, writes inside tools) runs on the default thread pool.
+    method = getattr(store, f"{name}_async", None)
+    if method:
+        return await method(*args)
+    return await asyncio.to_thread(getattr(store, name), *args)
+
+
+async def _llm_async(messages, kwargs):
+    return await groq_chat_async(messages, **kwargs)
+
+
+async def _tool_async(func, kwargs):
+    return await asyncio.to_thread(func, **kwargs)
+
+
+async def agent_process_message_async(user_message, user_id, chat_history=None):
+    return await drive_async(
+        _agent_steps(user_message, user_id),
+        {"store": _store_async, "llm": _llm_async, "tool": _tool_async},
+    )
+
+
+# === DASHBOARD AUTH ===
+def dashboard_token(user_id):
+    """Per-user dashboard login token: '<user_id>.<hmac>'"""
+    sig = hmac.new(
+        DASHBOARD_SECRET.encode(), str(user_id).encode(), hashlib.sha256
+    ).hexdigest()[:32]
+    return f"{user_id}.{sig}"
+
+
+def dashboard_user(credential=None):
+    """Resolve the dashboard credential to a user id, or None if invalid"""
+    if credential is None:
+        credential = request.headers.get("X-Dashboard-Password") or ""
+    if credential == DASHBOARD_PASSWORD:
+        return DASHBOARD_OWNER_ID
+    uid, _, _ = credential.partition(".")
+    if DASHBOARD_SECRET and uid.isdigit():
+        if hmac.compare_digest(credential, dashboard_token(int(uid))):
+            return int(uid)
+    return None
+
+
 # === FLASK ENDPOINTS ===
+def invalid_date_arg(*names):
+    """Name of the first query param that is set but not an ISO date"""
+    for name in names:
+        value = request.args.get(name)
+        if value:
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                return name
+    return None
+
+
 @app.route("/api/stats", methods=["GET"])
 def get_dashboard_stats():
-    if request.headers.get("X-Dashboard-Password") != DASHBOARD_PASSWORD:
+    user_id = dashboard_user()
+    if user_id is None:
         return jsonify({"error": "Unauthorized"}), 401
+    # Several open dashboard tabs refreshing together share one fan-out
+    return jsonify(stats_flight.do(user_id, dashboard_stats, user_id))
+
+
+stats_flight = SingleFlight("stats")
+
+
+def dashboard_stats(user_id):
     now = datetime.now()
     first_of_month = now.replace(day=1).strftime("%Y-%m-%d")
-    exp_resp = supabase_request(
-        f"expenses?created_at=gte.{first_of_month}&select=amount,category,item,created_at"
-    )
-    expenses_month = exp_resp.json() if exp_resp and exp_resp.status_code == 200 else []
-    inc_resp = supabase_request(
-        f"income?created_at=gte.{first_of_month}&select=amount,source,created_at"
-    )
-    income_month = inc_resp.json() if inc_resp and inc_resp.status_code == 200 else []
-    cat_resp = supabase_request("expenses?select=category,amount")
+    snap = get_snapshot(user_id)
+    month = {"income": 0, "expenses": 0, "net": 0}
     categories = {}
-    if cat_resp and cat_resp.status_code == 200:
-        for e in cat_resp.json():
-            cat = e.get("category", "Misc")
-            categories[cat] = categories.get(cat, 0) + float(e.get("amount", 0))
-    hist_resp = supabase_request(
-        "expenses?select=item,amount,category,created_at&order=created_at.desc&limit=10"
-    )
     history = []
-    if hist_resp and hist_resp.status_code == 200:
-        for e in hist_resp.json():
+    if snap is not None:
+        month = snap.totals(start=first_of_month)
+        categories = snap.by_category()
+        for row in snap.rows(snap.recent(10)):
             history.append(
                 {
-                    "item": e.get("item"),
-                    "amount": float(e.get("amount", 0)),
-                    "category": e.get("category", "Misc"),
-                    "date": e.get("created_at", "")[:10],
+                    "item": row["item"],
+                    "amount": row["amount"],
+                    "category": row["category"],
+                    "date": row["created_at"][:10],
                 }
             )
-    sub_resp = supabase_request(
-        "subscriptions?is_active=eq.true&select=name,amount,billing_cycle"
-    )
     subscriptions = []
-    if sub_resp and sub_resp.status_code == 200:
-        for s in sub_resp.json():
-            subscriptions.append(
-                {
-                    "name": s.get("name"),
-                    "amount": float(s.get("amount", 0)),
-                    "billing_cycle": s.get("billing_cycle", "monthly"),
-                }
-            )
-    goals_resp = supabase_request(
-        "savings_goals?is_active=eq.true&select=name,target_amount,current_amount"
-    )
-    goals = goals_resp.json() if goals_resp and goals_resp.status_code == 200 else []
-    prof_resp = supabase_request("financial_profile?user_id=eq.1")
+    for s in active_subscriptions_cached(user_id):
+        subscriptions.append(
+            {
+                "name": s.get("name"),
+                "amount": float(s.get("amount", 0)),
+                "billing_cycle": s.get("billing_cycle", "monthly"),
+            }
+        )
+    goals = store.active_goals(user_id) or []
     budget = 0
     goals_text = "Save money"
-    if prof_resp and prof_resp.json():
-        p = prof_resp.json()[0]
+    p = store.get_profile(user_id)
+    if p:
         budget = float(p.get("budget", 0))
         goals_text = p.get("goals", "Save money")
-    total_spent = sum(float(e.get("amount", 0)) for e in expenses_month)
-    total_income = sum(float(i.get("amount", 0)) for i in income_month)
+    forecast = forecast_month_end(user_id, snap)
+    return {
+        "income": month["income"],
+        "expenses": month["expenses"],
+        "forecast": forecast["projected_month_end"],
+        "net": month["net"],
+        "budget": budget,
+        "goals": goals_text,
+        "categories": categories,
+        "history": history,
+        "subscriptions": subscriptions,
+        "savings_goals": goals,
+    }
+
+
+@app.route("/api/timeseries", methods=["GET"])
+def get_timeseries_endpoint():
+    user_id = dashboard_user()
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    granularity = request.args.get("granularity", "day")
+    if granularity not in GRANULARITIES:
+        return jsonify({"error": f"granularity must be one of {GRANULARITIES}"}), 400
+    bad = invalid_date_arg("start", "end")
+    if bad:
+        return jsonify({"error": f"{bad} must be an ISO date (YYYY-MM-DD)"}), 400
+    series = get_timeseries(
+        user_id,
+        granularity,
+        request.args.get("start"),
+        request.args.get("end"),
+        request.args.get("by_category") in ("1", "true"),
+    )
+    if series is None:
+        return jsonify({"error": "Query failed"}), 502
+    resp = jsonify({"granularity": granularity, "series": series})
+    resp.headers["Cache-Control"] = "private, max-age=60"
+    return resp
+
+
+@app.route("/api/import", methods=["POST"])
+def import_endpoint():
+    """Stream a CSV body in; stream NDJSON progress lines out"""
+    user_id = dashboard_user()
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    skip = request.args.get("skip", "0")
+    if not skip.isdigit():
+        return jsonify({"error": "skip must be a non-negative integer"}), 400
+    upload = request.files.get("file")
+    raw = upload.stream if upload else request.stream
+    lines = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    progress = import_statement(
+        user_id,
+        lines,
+        positive_is_income=request.args.get("positive_is_income") in ("1", "true"),
+        skip=int(skip),
+    )
+    return Response(
+        stream_with_context(json.dumps(p) + "\n" for p in progress),
+        mimetype="application/x-ndjson",
+    )
+
+
+@app.route("/api/export", methods=["GET"])
+def export_endpoint():
+    user_id = dashboard_user()
+    if user_id is None:
+        return jsonify({"error": "Unauthorized"}), 401
+    table = request.args.get("table", "expenses")
+    fmt = request.args.get("format", "csv")
+    if table not in EXPORT_COLUMNS or fmt not in ("csv", "ndjson"):
+        return (
+            jsonify({"error": "table must be expenses|income, format csv|ndjson"}),
+            400,
+        )
+    # Checked before streaming: a bad date mid-stream would be a broken 200
+    bad = invalid_date_arg("start", "end")
+    if bad:
+        return jsonify({"error": f"{bad} must be an ISO date (YYYY-MM-DD)"}), 400
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    resp = Response(
+        stream_with_context(
+            export_lines(
+                user_id, table, fmt, request.args.get("start"), request.args.get("end")
+            )
+        ),
+        mimetype=mimetype,
+    )
+    resp.headers["Content-Disposition"] = f"attachment; filename={table}.{fmt}"
+    return resp
+
+
+@app.route("/api/cron/billing", methods=["GET", "POST"])
+def cron_billing():
+    from_cron = CRON_SECRET and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {CRON_SECRET}"
+    )
+    if (
+        not from_cron
+        and request.headers.get("X-Dashboard-Password") != DASHBOARD_PASSWORD
+    ):
+        return jsonify({"error": "Unauthorized"}), 401
+    result = run_billing()
+    return jsonify(result), 200 if result["success"] else 502
+
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    if request.headers.get("X-Dashboard-Password") != DASHBOARD_PASSWORD:
+        return jsonify({"error": "Unauthorized"}), 401
     return jsonify(
         {
-            "income": total_income,
-            "expenses": total_spent,
-            "net": total_income - total_spent,
-            "budget": budget,
-            "goals": goals_text,
-            "categories": categories,
-            "history": history,
-            "subscriptions": subscriptions,
-            "savings_goals": goals,
+            "groq": groq_metrics(),
+            "response_cache": response_cache_metrics(),
+            "timeseries": METRICS["timeseries"],
+            "search": METRICS["search"],
+            "single_flight": METRICS["single_flight"],
+            "tool_results": dict(
+                METRICS["tool_results"],
+                tokens_saved=METRICS["tool_results"]["tokens_in"]
+                - METRICS["tool_results"]["tokens_out"],
+            ),
+            "chat_history": dict(
+                METRICS["chat_history"], backlog=history_buffer.backlog()
+            ),
+            "watcher": METRICS["watcher"],
         }
     )
 
 
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
-    password = request.headers.get("X-Dashboard-Password")
-    if password != DASHBOARD_PASSWORD:
+    user_id = dashboard_user()
+    if user_id is None:
         return jsonify({"error": "Unauthorized"}), 401
     data = request.json or {}
     user_message = data.get("message", "")
     history = data.get("history", [])
     if not user_message.strip():
         return jsonify({"response": "You didn't say anything..."})
-    response = agent_process_message(user_message, user_id=1, chat_history=history)
-    return jsonify({"response": response})
+    response = agent_process_message(
+        user_message, user_id=user_id, chat_history=history
+    )
+    resp = jsonify({"response": response})
+    resp.call_on_close(history_buffer.flush)
+    return resp
 
 
 # === EMBEDDED DASHBOARD HTML ===
@@ -642,8 +3396,8 @@ DASHBOARD_HTML = """
         <div class="card max-w-sm mx-4 w-full text-center">
             <div class="mb-4 text-4xl">🔐</div>
             <h2 class="text-2xl font-bold mb-2 text-green-400">ContabilBOT CFO</h2>
-            <p class="text-gray-400 mb-6 text-sm">Enter your dashboard password</p>
-            <input type="password" id="password" placeholder="Password" class="w-full bg-gray-700 border border-gray-600 text-white px-4 py-3 rounded-lg mb-4 focus:outline-none focus:ring-2 focus:ring-green-500" onkeypress="if(event.key==='Enter')login()">
+            <p class="text-gray-400 mb-6 text-sm">Enter your dashboard password or the key from /dashboard</p>
+            <input type="password" id="password" placeholder="Password or /dashboard key" class="w-full bg-gray-700 border border-gray-600 text-white px-4 py-3 rounded-lg mb-4 focus:outline-none focus:ring-2 focus:ring-green-500" onkeypress="if(event.key==='Enter')login()">
             <button onclick="login()" class="w-full bg-green-500 hover:bg-green-600 text-black font-bold py-3 rounded-lg transition">Unlock Dashboard</button>
             <p id="errorMsg" class="text-red-400 mt-4 text-sm hidden">Invalid password. Try again.</p>
         </div>
@@ -669,6 +3423,7 @@ DASHBOARD_HTML = """
             <div class="card">
                 <p class="text-gray-400 text-xs uppercase tracking-wider">Expenses (Month)</p>
                 <p class="text-2xl md:text-3xl font-bold text-red-400 mt-1" id="expenseTotal">-</p>
+                <p class="text-xs text-gray-500 mt-1">Forecast: <span id="expenseForecast">-</span></p>
             </div>
             <div class="card">
                 <p class="text-gray-400 text-xs uppercase tracking-wider">Net Savings</p>
@@ -691,6 +3446,11 @@ DASHBOARD_HTML = """
             </div>
         </div>
 
+        <div class="card mb-8">
+            <h3 class="text-lg font-bold mb-4 flex items-center gap-2"><span>📉</span> Weekly Trend (12 weeks)</h3>
+            <div class="h-64"><canvas id="trendChart"></canvas></div>
+        </div>
+
         <div class="grid grid-cols-1 lg:grid-cols-2 gap-4 mb-8">
             <div class="card">
                 <h3 class="text-lg font-bold mb-4 flex items-center gap-2"><span>🔄</span> Subscriptions <span class="text-xs bg-red-500/20 text-red-400 px-2 py-0.5 rounded" id="subBadge">0</span></h3>
@@ -752,6 +3512,7 @@ DASHBOARD_HTML = """
         const API = '/api';
         let catChart = null;
         let incomeChart = null;
+        let trendChart = null;
         let chatHistory = [];
 
         function getHeaders() { return { 'X-Dashboard-Password': localStorage.getItem('dash_pwd') || '', 'Content-Type': 'application/json' }; }
@@ -820,12 +3581,14 @@ DASHBOARD_HTML = """
                 document.getElementById('loginModal').classList.add('hidden');
                 document.getElementById('dashboard').classList.remove('hidden');
                 renderDashboard(await res.json());
+                loadTrend();
             } catch (e) { console.error('Dashboard load error:', e); alert('Failed to connect.'); }
         }
 
         function renderDashboard(data) {
             document.getElementById('incomeTotal').textContent = (data.income || 0).toLocaleString();
             document.getElementById('expenseTotal').textContent = (data.expenses || 0).toLocaleString();
+            document.getElementById('expenseForecast').textContent = (data.forecast || 0).toLocaleString();
             document.getElementById('netSavings').textContent = (data.net || 0).toLocaleString();
             document.getElementById('netSavings').className = 'text-2xl md:text-3xl font-bold mt-1 ' + ((data.net || 0) >= 0 ? 'text-green-400' : 'text-red-400');
             document.getElementById('budgetDisplay').textContent = (data.budget || 0).toLocaleString();
@@ -852,6 +3615,21 @@ DASHBOARD_HTML = """
             incomeChart = new Chart(ctx, { type: 'bar', data: { labels: ['Income', 'Expenses'], datasets: [{ data: [income, expenses], backgroundColor: ['#22c55e', '#ef4444'], borderRadius: 8 }] }, options: { responsive: true, maintainAspectRatio: false, plugins: { legend: { display: false } }, scales: { y: { beginAtZero: true, ticks: { color: '#9ca3af' }, grid: { color: '#334155' } }, x: { ticks: { color: '#9ca3af' }, grid: { display: false } } } } });
         }
 
+        async function loadTrend() {
+            try {
+                const res = await fetch(API + '/timeseries?granularity=week', { headers: getHeaders() });
+                if (res.ok) renderTrendChart((await res.json()).series || []);
+            } catch (e) { console.error('Trend load error:', e); }
+        }
+
+        function renderTrendChart(series) {
+            const ctx = document.getElementById('trendChart').getContext('2d');
+            if (trendChart) trendChart.destroy();
+            const labels = series.map(p => p.bucket);
+            const line = (label, key, color) => ({ label: label, data: series.map(p => p[key]), borderColor: color, backgroundColor: color, tension: 0.3, pointRadius: 3 });
+            trendChart = new Chart(ctx, { type: 'line', data: { labels: labels, datasets: [line('Income', 'income', '#22c55e'), line('Expenses', 'expenses', '#ef4444'), line('Net', 'net', '#3b82f6')] }, options: { responsive: true, maintainAspectRatio: false, plugins: { legend: { labels: { color: '#9ca3af' } } }, scales: { y: { ticks: { color: '#9ca3af' }, grid: { color: '#334155' } }, x: { ticks: { color: '#9ca3af' }, grid: { display: false } } } } });
+        }
+
         function renderTransactions(history) {
             const tbody = document.getElementById('transactionsTable');
             if (!history || history.length === 0) { tbody.innerHTML = '<tr><td colspan="4" class="py-4 text-center text-gray-500">No transactions yet</td></tr>'; return; }
@@ -892,6 +3670,9 @@ def webhook():
         update = Update.de_json(json_str)
         if update:
             bot.process_new_updates([update])
+            # The reply is already sent; persist history before the
+            # serverless function is frozen.
+            history_buffer.flush()
         return "OK", 200
     except Exception as e:
         print(f"Webhook error: {e}")
@@ -899,6 +3680,21 @@ def webhook():
 
 
 # === TELEGRAM HANDLERS ===
+# Canned questions behind the menu buttons and their /commands
+QUICK_PROMPTS = {
+    "total": "Give me my total spending and income summary for this month",
+    "highest": "What was my highest single expense?",
+    "history": "Show me my recent spending history with dates and categories",
+    "analyze": "Analyze my spending habits and give me a witty roast with specific numbers",
+}
+QUICK_BUTTONS = {
+    "💰 Total": "total",
+    "🏆 Highest": "highest",
+    "📜 History": "history",
+    "🧠 Analyze": "analyze",
+}
+
+
 def get_main_menu():
     markup = telebot.types.ReplyKeyboardMarkup(
         resize_keyboard=True, one_time_keyboard=False
@@ -935,12 +3731,33 @@ def send_help(message):
 • "How much on food?"
 • "Net savings?"
 
-**Dashboard:** https://contabil-bot.vercel.app/"""
+**Dashboard:** https://contabil-bot.vercel.app/
+Send /dashboard to get your personal login key."""
     bot.send_message(
         message.chat.id, help_text, parse_mode="Markdown", reply_markup=get_main_menu()
     )
 
 
+@bot.message_handler(commands=["dashboard"])
+def send_dashboard_token(message):
+    if not DASHBOARD_SECRET:
+        bot.send_message(message.chat.id, "Dashboard tokens are not configured.")
+        return
+    # The key logs in as this user: never post it where other members see it
+    if message.chat.type != "private":
+        bot.send_message(
+            message.chat.id, "Send /dashboard to me in a private chat for your key."
+        )
+        return
+    bot.send_message(
+        message.from_user.id,
+        "🔑 Your personal dashboard key (paste it as the password):\n"
+        f"`{dashboard_token(message.from_user.id)}`",
+        parse_mode="Markdown",
+        reply_markup=get_main_menu(),
+    )
+
+
 @bot.message_handler(func=lambda m: m.text == "❓ Help")
 def help_btn(message):
     send_help(message)
@@ -950,7 +3767,9 @@ def help_btn(message):
 @bot.message_handler(commands=["total"])
 def total_btn(message):
     response = agent_process_message(
-        "Give me my total spending and income summary for this month", chat_history=[]
+        QUICK_PROMPTS["total"],
+        user_id=message.from_user.id,
+        chat_history=[],
     )
     bot.send_message(
         message.chat.id, response, parse_mode="Markdown", reply_markup=get_main_menu()
@@ -961,7 +3780,9 @@ def total_btn(message):
 @bot.message_handler(commands=["highest"])
 def highest_btn(message):
     response = agent_process_message(
-        "What was my highest single expense?", chat_history=[]
+        QUICK_PROMPTS["highest"],
+        user_id=message.from_user.id,
+        chat_history=[],
     )
     bot.send_message(
         message.chat.id, response, parse_mode="Markdown", reply_markup=get_main_menu()
@@ -972,7 +3793,9 @@ def highest_btn(message):
 @bot.message_handler(commands=["history"])
 def history_btn(message):
     response = agent_process_message(
-        "Show me my recent spending history with dates and categories", chat_history=[]
+        QUICK_PROMPTS["history"],
+        user_id=message.from_user.id,
+        chat_history=[],
     )
     bot.send_message(
         message.chat.id, response, parse_mode="Markdown", reply_markup=get_main_menu()
@@ -983,7 +3806,8 @@ def history_btn(message):
 @bot.message_handler(commands=["analyze"])
 def analyze_btn(message):
     response = agent_process_message(
-        "Analyze my spending habits and give me a witty roast with specific numbers",
+        QUICK_PROMPTS["analyze"],
+        user_id=message.from_user.id,
         chat_history=[],
     )
     bot.send_message(
@@ -993,11 +3817,296 @@ def analyze_btn(message):
 
 @bot.message_handler(func=lambda m: True)
 def handle_message(message):
-    response = agent_process_message(message.text)
+    response = agent_process_message(message.text, user_id=message.from_user.id)
     bot.send_message(
         message.chat.id, response, parse_mode="Markdown", reply_markup=get_main_menu()
     )
 
 
+# === ASGI SERVING MODE ===
+# With SERVER_MODE=asgi (or `python api/index.py serve-async`) `app` is this
+# ASGI callable. The slow paths, Telegram updates that reach the agent and
+# /api/chat, run on the event loop with awaited Supabase/Groq/Telegram calls,
+# so one worker holds many in-flight LLM round trips. Every other route is
+# handed to the Flask app on a worker thread.
+def _agent_prompt(text):
+    """The agent question for a Telegram text, or None for bot commands"""
+    command = (
+        text.split()[0].split("@")[0].lstrip("/") if text.startswith("/") else None
+    )
+    if command:
+        return QUICK_PROMPTS.get(command)
+    if text in QUICK_BUTTONS:
+        return QUICK_PROMPTS[QUICK_BUTTONS[text]]
+    if text == "❓ Help":
+        return None
+    return text
+
+
+async def handle_update_async(payload):
+    message = payload.get("message") or {}
+    text = message.get("text")
+    prompt = _agent_prompt(text) if text else None
+    if prompt is None:
+        # /start, /help, /dashboard and non-text updates: the telebot handlers
+        await asyncio.to_thread(bot.process_new_updates, [Update.de_json(payload)])
+        return
+    response = await agent_process_message_async(prompt, user_id=message["from"]["id"])
+    await telegram_request_async(
+        "sendMessage",
+        chat_id=message["chat"]["id"],
+        text=response,
+        parse_mode="Markdown",
+        reply_markup=get_main_menu().to_json(),
+    )
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        event = await receive()
+        chunks.append(event.get("body", b""))
+        if not event.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _respond(send, status, body, content_type="application/json"):
+    if not isinstance(body, bytes):
+        body = (body if isinstance(body, str) else json.dumps(body)).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type.encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def webhook_async(scope, receive, send):
+    if not TOKEN:
+        return await _respond(send, 500, "Error", "text/plain")
+    try:
+        await handle_update_async(json.loads(await _read_body(receive)))
+    except Exception as e:
+        print(f"Webhook error: {e}")
+        return await _respond(send, 500, "Error", "text/plain")
+    await _respond(send, 200, "OK", "text/plain")
+    await asyncio.to_thread(history_buffer.flush)
+
+
+async def api_chat_async(scope, receive, send):
+    headers = dict(scope["headers"])
+    credential = headers.get(b"x-dashboard-password", b"").decode()
+    user_id = dashboard_user(credential)
+    body = await _read_body(receive)
+    if user_id is None:
+        return await _respond(send, 401, {"error": "Unauthorized"})
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+    user_message = data.get("message", "")
+    if not user_message.strip():
+        return await _respond(send, 200, {"response": "You didn't say anything..."})
+    response = await agent_process_message_async(user_message, user_id=user_id)
+    await _respond(send, 200, {"response": response})
+    await asyncio.to_thread(history_buffer.flush)
+
+
+ASYNC_ROUTES = {("POST", "/"): webhook_async, ("POST", "/api/chat"): api_chat_async}
+
+
+class _AsgiBody(io.RawIOBase):
+    """wsgi.input for the worker thread: pulls body chunks off the loop's
+    bounded queue as Flask reads, so uploads are never held whole"""
+
+    def __init__(self, queue, loop):
+        self._queue, self._loop = queue, loop
+        self._chunk, self._eof = b"", False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and not self._eof:
+            chunk = asyncio.run_coroutine_threadsafe(
+                self._queue.get(), self._loop
+            ).result()
+            self._chunk, self._eof = chunk or b"", chunk is None
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+async def _feed_body(receive, queue):
+    while True:
+        event = await receive()
+        if event["type"] == "http.disconnect":
+            break
+        if event.get("body"):
+            await queue.put(event["body"])
+        if not event.get("more_body"):
+            break
+    await queue.put(None)
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # Read to EOF even without a Content-Length (chunked uploads)
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+        else:
+            key = f"HTTP_{key}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def wsgi_fallback(scope, receive, send):
+    """Run the Flask app on one worker thread, streaming both bodies"""
+    loop = asyncio.get_running_loop()
+    # Bounded both ways: a slow reader (Flask for imports, the client for
+    # exports) applies backpressure instead of buffering the whole body
+    body_queue = asyncio.Queue(maxsize=8)
+    feeder = asyncio.ensure_future(_feed_body(receive, body_queue))
+    body = io.BufferedReader(_AsgiBody(body_queue, loop))
+    environ = _wsgi_environ(scope, body)
+    queue = asyncio.Queue(maxsize=8)
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put(("start", int(status.split()[0]), headers))
+
+    def run():
+        try:
+            result = flask_app.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    if chunk:
+                        put(("body", chunk))
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except Exception as e:
+            print(f"WSGI error: {e}")
+        finally:
+            put(("end", None))
+
+    worker = loop.run_in_executor(None, run)
+    started, kind = False, None
+    try:
+        while kind != "end":
+            kind, *rest = await queue.get()
+            if kind == "start":
+                status, headers = rest
+                await send(
+                    {
+                        "type": "http.response.start",
+                        "status": status,
+                        "headers": [(k.encode(), v.encode()) for k, v in headers],
+                    }
+                )
+                started = True
+            elif kind == "body":
+                await send(
+                    {"type": "http.response.body", "body": rest[0], "more_body": True}
+                )
+    finally:
+        # If the client went away, keep draining so the worker never blocks
+        while kind != "end":
+            kind, *rest = await queue.get()
+        # Flask may not read the whole request body
+        feeder.cancel()
+    await worker
+    if not started:
+        return await _respond(send, 500, "Error", "text/plain")
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await close_async_http()
+                await asyncio.to_thread(history_buffer.flush)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    handler = ASYNC_ROUTES.get((scope["method"], scope["path"]), wsgi_fallback)
+    await handler(scope, receive, send)
+
+
+flask_app = app
+if SERVER_MODE == "asgi":
+    app = asgi_app
+
+
+def cli_import(argv):
+    parser = argparse.ArgumentParser(prog="index.py import")
+    parser.add_argument("path", help="CSV file, or - for stdin")
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument(
+        "--positive-is-income",
+        action="store_true",
+        help="signed Amount column: positive rows are income (Debit/Credit "
+        "columns always map credits to income)",
+    )
+    parser.add_argument("--skip", type=int, default=0, help="rows to skip (resume)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    f = (
+        sys.stdin
+        if args.path == "-"
+        else open(args.path, encoding="utf-8-sig", newline="")
+    )
+    with f:
+        for p in import_statement(
+            args.user_id, f, args.positive_is_income, args.skip, args.chunk_size
+        ):
+            print(json.dumps(p), flush=True)
+            if p.get("error"):
+                return 1
+    return 0
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        sys.exit(cli_import(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bill":
+        result = run_billing()
+        print(json.dumps(result))
+        sys.exit(0 if result["success"] else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == "serve-async":
+        import uvicorn
+
+        uvicorn.run(asgi_app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+        sys.exit(0)
+    flask_app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
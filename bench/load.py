@@ -0,0 +1,70 @@
+"""Fire N concurrent requests at bench/serve.py and print one JSON line.
+
+    python bench/load.py N [webhook|chat] [url]
+
+webhook posts Telegram updates from N different users; chat posts N
+different /api/chat questions.
+"""
+
+import asyncio
+import json
+import sys
+import time
+
+import httpx
+
+N = int(sys.argv[1])
+TARGET = sys.argv[2] if len(sys.argv) > 2 else "webhook"
+URL = sys.argv[3] if len(sys.argv) > 3 else "http://127.0.0.1:9100"
+PASSWORD = "contabil123"
+
+
+def update(i):
+    user = {"id": 1000 + i, "is_bot": False, "first_name": "u"}
+    return {
+        "update_id": i,
+        "message": {
+            "message_id": i,
+            "date": 0,
+            "text": f"how much did I spend {i}",
+            "chat": {"id": 1000 + i, "type": "private"},
+            "from": user,
+        },
+    }
+
+
+async def one(client, i):
+    started = time.perf_counter()
+    if TARGET == "webhook":
+        resp = await client.post(URL + "/", json=update(i))
+    else:
+        resp = await client.post(
+            URL + "/api/chat",
+            json={"message": f"question {i}"},
+            headers={"X-Dashboard-Password": PASSWORD},
+        )
+    return resp.status_code, time.perf_counter() - started
+
+
+async def main():
+    limits = httpx.Limits(max_connections=N)
+    async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one(client, i) for i in range(N)))
+        wall = time.perf_counter() - started
+    latencies = sorted(t for _, t in results)
+    print(
+        json.dumps(
+            {
+                "n": N,
+                "ok": sum(1 for status, _ in results if status == 200),
+                "wall_s": round(wall, 2),
+                "p50_s": round(latencies[len(latencies) // 2], 2),
+                "max_s": round(latencies[-1], 2),
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
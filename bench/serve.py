@@ -0,0 +1,39 @@
+"""Run the bot against bench/upstream.py on one worker.
+
+    python bench/serve.py wsgi|asgi [port]
+
+wsgi is the sync Flask app with one request at a time, as on one
+Vercel Python worker; asgi is SERVER_MODE=asgi under uvicorn.
+"""
+
+import os
+import sys
+import tempfile
+
+UPSTREAM = os.environ.get("BENCH_UPSTREAM", "http://127.0.0.1:9000")
+os.environ.update(
+    TELEGRAM_TOKEN="123:abc",
+    SUPABASE_URL=UPSTREAM,
+    SUPABASE_KEY="bench",
+    GROQ_API_KEY="bench",
+    GROQ_BASE_URL=UPSTREAM,
+    STORAGE_BACKEND="sqlite",
+    SQLITE_PATH=os.path.join(tempfile.mkdtemp(), "bench.db"),
+)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import telebot  # noqa: E402
+
+telebot.apihelper.API_URL = UPSTREAM + "/bot{0}/{1}"
+
+import index  # noqa: E402
+
+if __name__ == "__main__":
+    mode = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 9100
+    if mode == "wsgi":
+        index.flask_app.run(port=port, threaded=False)
+    else:
+        import uvicorn
+
+        uvicorn.run(index.asgi_app, port=port, log_level="warning")
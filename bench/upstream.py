@@ -0,0 +1,69 @@
+"""Stub Groq, Supabase and Telegram upstreams for the load test.
+
+Every chat completion takes LLM_DELAY seconds. A request offering tools
+gets one tool_get_summary call back; the follow-up gets a text answer.
+
+    uvicorn bench.upstream:app --port 9000
+"""
+
+import asyncio
+import json
+import os
+import time
+
+LLM_DELAY = float(os.environ.get("BENCH_LLM_DELAY", "1"))
+
+
+def completion(req):
+    if "tools" in req:
+        call = {
+            "id": "c1",
+            "type": "function",
+            "function": {
+                "name": "tool_get_summary",
+                "arguments": json.dumps({"period": "this_month"}),
+            },
+        }
+        message = {"role": "assistant", "content": None, "tool_calls": [call]}
+        finish = "tool_calls"
+    else:
+        message = {"role": "assistant", "content": "You spent 42 MDL, you animal."}
+        finish = "stop"
+    return {
+        "id": "bench",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": req["model"],
+        "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+async def app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            break
+    path = scope["path"]
+    if path.endswith("/chat/completions"):
+        await asyncio.sleep(LLM_DELAY)
+        out = completion(json.loads(body))
+    elif "/rest/v1/" in path:
+        await asyncio.sleep(0.05)
+        out = []
+    else:
+        # Telegram sendMessage
+        chat = {"id": 1, "type": "private"}
+        out = {"ok": True, "result": {"message_id": 1, "date": 0, "chat": chat}}
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": json.dumps(out).encode()})
@@ -20,8 +20,15 @@ INSERT INTO financial_profile (user_id, budget, goals)
 SELECT 1, 5000, 'Save money'
 WHERE NOT EXISTS (SELECT 1 FROM financial_profile WHERE user_id = 1);
 
+CREATE UNIQUE INDEX IF NOT EXISTS idx_financial_profile_user ON financial_profile(user_id);
+
 -- expenses table (should already exist)
 -- ALTER TABLE expenses ADD COLUMN IF NOT EXISTS user_note TEXT;
+-- Existing rows belong to the original single user (id 1)
+ALTER TABLE expenses ADD COLUMN IF NOT EXISTS user_id BIGINT DEFAULT 1;
+-- Set on charges materialized from subscriptions; unique per user so the
+-- billing job can be re-run safely (NULLs never conflict)
+ALTER TABLE expenses ADD COLUMN IF NOT EXISTS billing_key TEXT;
 
 -- ============================================
 -- NEW TABLES FOR v5.0
@@ -59,6 +66,9 @@ CREATE TABLE IF NOT EXISTS subscriptions (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Next charge the billing job will materialize (NULL = created_at)
+ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS next_billing_at TIMESTAMP WITH TIME ZONE;
+
 -- Savings goals tracking table
 CREATE TABLE IF NOT EXISTS savings_goals (
     id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
@@ -75,12 +85,230 @@ CREATE TABLE IF NOT EXISTS savings_goals (
 -- INDEXES FOR PERFORMANCE
 -- ============================================
 
+-- Every query is scoped to one user, so user_id leads each index and one
+-- user's history size never affects another user's scans. The trailing id
+-- serves the (created_at, id) keyset pagination used by /api/export.
+DROP INDEX IF EXISTS idx_expenses_created;
+DROP INDEX IF EXISTS idx_expenses_category;
+DROP INDEX IF EXISTS idx_income_created;
+DROP INDEX IF EXISTS idx_subscriptions_active;
+DROP INDEX IF EXISTS idx_goals_active;
+
 CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history(user_id, created_at DESC);
-CREATE INDEX IF NOT EXISTS idx_expenses_created ON expenses(created_at);
-CREATE INDEX IF NOT EXISTS idx_expenses_category ON expenses(category);
-CREATE INDEX IF NOT EXISTS idx_income_created ON income(created_at);
-CREATE INDEX IF NOT EXISTS idx_subscriptions_active ON subscriptions(is_active);
-CREATE INDEX IF NOT EXISTS idx_goals_active ON savings_goals(is_active);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_created ON expenses(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses(user_id, category);
+CREATE INDEX IF NOT EXISTS idx_income_user_created ON income(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active);
+CREATE INDEX IF NOT EXISTS idx_goals_user_active ON savings_goals(user_id, is_active);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_billing_key ON expenses(user_id, billing_key);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_due ON subscriptions(next_billing_at) WHERE is_active;
+
+-- Fuzzy item search. Labels are compared on search_key(): lower-cased with
+-- everything but letters and digits stripped, so "Uber Eats" and "UberEats"
+-- share one key. btree_gin lets user_id lead the trigram index as well.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE OR REPLACE FUNCTION search_key(p_text TEXT)
+RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT regexp_replace(lower(COALESCE(p_text, '')), '[^[:alnum:]]+', '', 'g');
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_expenses_item_trgm
+    ON expenses USING gin (user_id, search_key(item) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_income_source_trgm
+    ON income USING gin (user_id, search_key(source) gin_trgm_ops);
+
+-- ============================================
+-- ANALYTICS FUNCTIONS
+-- ============================================
+
+-- Income/expense totals bucketed by day, week or month; called by
+-- /api/timeseries via POST /rest/v1/rpc/transaction_timeseries so only
+-- bucket rows are transferred. Runs as the caller, so RLS still applies.
+CREATE OR REPLACE FUNCTION transaction_timeseries(
+    p_user_id BIGINT,
+    p_start TIMESTAMPTZ,
+    p_end TIMESTAMPTZ,
+    p_granularity TEXT DEFAULT 'day',
+    p_by_category BOOLEAN DEFAULT FALSE
+)
+RETURNS TABLE (bucket DATE, category TEXT, income NUMERIC, expenses NUMERIC)
+LANGUAGE sql STABLE AS $$
+    WITH tx AS (
+        SELECT date_trunc(p_granularity, created_at)::DATE AS bucket,
+               CASE WHEN p_by_category THEN category END AS category,
+               0::NUMERIC AS income,
+               amount AS expenses
+        FROM expenses
+        WHERE user_id = p_user_id AND created_at >= p_start AND created_at <= p_end
+        UNION ALL
+        SELECT date_trunc(p_granularity, created_at)::DATE, NULL, amount, 0
+        FROM income
+        WHERE user_id = p_user_id AND created_at >= p_start AND created_at <= p_end
+    )
+    SELECT bucket, category, SUM(income), SUM(expenses)
+    FROM tx
+    GROUP BY bucket, category
+    ORDER BY bucket, category;
+$$;
+
+-- A user's expense and income row counts. Both tables are append-only, so
+-- the pair works as a ledger version: each instance probes it to notice
+-- rows written by other instances before serving from memory. Answered
+-- from the user_id indexes. Runs as the caller, so RLS applies.
+CREATE OR REPLACE FUNCTION ledger_counts(p_user_id BIGINT)
+RETURNS TABLE (expenses BIGINT, income BIGINT)
+LANGUAGE sql STABLE AS $$
+    SELECT (SELECT count(*) FROM expenses WHERE user_id = p_user_id),
+           (SELECT count(*) FROM income WHERE user_id = p_user_id);
+$$;
+
+-- Fuzzy search over expenses.item or income.source, ranked by trigram
+-- similarity then recency; called by search_transactions() via
+-- POST /rest/v1/rpc/search_transactions. Both the % (similarity) and the
+-- LIKE (substring) filters are served by the trigram GIN indexes above.
+-- A NULL p_limit returns every match. Runs as the caller, so RLS applies.
+CREATE OR REPLACE FUNCTION search_transactions(
+    p_user_id BIGINT,
+    p_query TEXT,
+    p_table TEXT DEFAULT 'expenses',
+    p_start TIMESTAMPTZ DEFAULT NULL,
+    p_end TIMESTAMPTZ DEFAULT NULL,
+    p_category TEXT DEFAULT NULL,
+    p_limit INTEGER DEFAULT 20,
+    p_min_similarity REAL DEFAULT 0.3
+)
+RETURNS TABLE (
+    id BIGINT,
+    label TEXT,
+    amount NUMERIC,
+    category TEXT,
+    created_at TIMESTAMPTZ,
+    score REAL
+)
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    q TEXT := search_key(p_query);
+BEGIN
+    IF q = '' THEN
+        RETURN;
+    END IF;
+    PERFORM set_config('pg_trgm.similarity_threshold', p_min_similarity::TEXT, true);
+    IF p_table = 'income' THEN
+        RETURN QUERY
+        SELECT i.id, i.source, i.amount, NULL::TEXT, i.created_at,
+               similarity(search_key(i.source), q)
+        FROM income i
+        WHERE i.user_id = p_user_id
+          AND (search_key(i.source) % q OR search_key(i.source) LIKE '%' || q || '%')
+          AND (p_start IS NULL OR i.created_at >= p_start)
+          AND (p_end IS NULL OR i.created_at <= p_end)
+        ORDER BY 6 DESC, i.created_at DESC
+        LIMIT p_limit;
+    ELSE
+        RETURN QUERY
+        SELECT e.id, e.item, e.amount, e.category, e.created_at,
+               similarity(search_key(e.item), q)
+        FROM expenses e
+        WHERE e.user_id = p_user_id
+          AND (search_key(e.item) % q OR search_key(e.item) LIKE '%' || q || '%')
+          AND (p_start IS NULL OR e.created_at >= p_start)
+          AND (p_end IS NULL OR e.created_at <= p_end)
+          AND (p_category IS NULL OR e.category = p_category)
+        ORDER BY 6 DESC, e.created_at DESC
+        LIMIT p_limit;
+    END IF;
+END;
+$$;
+
+-- Whole billing cycles from p_anchor to p_at, give or take one; used to
+-- start the charge search near p_at instead of at the first charge.
+CREATE OR REPLACE FUNCTION billing_cycles(
+    p_anchor TIMESTAMPTZ,
+    p_at TIMESTAMPTZ,
+    p_cycle TEXT
+)
+RETURNS INTEGER LANGUAGE sql STABLE AS $$
+    SELECT CASE p_cycle
+        WHEN 'weekly' THEN floor(extract(epoch FROM p_at - p_anchor) / 604800)::INTEGER
+        WHEN 'yearly' THEN (extract(year FROM p_at) - extract(year FROM p_anchor))::INTEGER
+        ELSE ((extract(year FROM p_at) - extract(year FROM p_anchor)) * 12
+              + extract(month FROM p_at) - extract(month FROM p_anchor))::INTEGER
+    END;
+$$;
+
+-- Subscription billing job (/api/cron/billing). Inserts every due weekly,
+-- monthly or yearly charge as an expense in one statement and advances
+-- next_billing_at. Charge dates are always created_at + n * cycle, so a
+-- subscription started on the 31st is charged on the last day of shorter
+-- months and back on the 31st after them; next_billing_at is only the
+-- "due from" cursor. Charges older than p_max_backfill_days are skipped,
+-- not inserted. ON CONFLICT on billing_key makes re-runs idempotent.
+-- The clock is always the server's now(), never a caller-supplied value,
+-- and only service_role may execute it: the job spans all users, so the
+-- app calls it with SUPABASE_SERVICE_KEY (which bypasses RLS).
+DROP FUNCTION IF EXISTS materialize_subscription_charges(TIMESTAMPTZ, INTEGER);
+CREATE OR REPLACE FUNCTION materialize_subscription_charges(
+    p_max_backfill_days INTEGER DEFAULT 31
+)
+RETURNS TABLE (user_id BIGINT, item TEXT, amount NUMERIC, created_at TIMESTAMPTZ)
+LANGUAGE sql VOLATILE AS $$
+    WITH clock AS (SELECT now() AS as_of),
+    due AS (
+        SELECT s.id, s.user_id, s.name, s.amount,
+               s.created_at AS anchor,
+               COALESCE(s.billing_cycle, 'monthly') AS cycle,
+               GREATEST(
+                   COALESCE(s.next_billing_at, s.created_at),
+                   clock.as_of - make_interval(days => p_max_backfill_days)
+               ) AS due_from,
+               CASE s.billing_cycle
+                   WHEN 'weekly' THEN INTERVAL '1 week'
+                   WHEN 'yearly' THEN INTERVAL '1 year'
+                   ELSE INTERVAL '1 month'
+               END AS step
+        FROM subscriptions s, clock
+        WHERE s.is_active AND COALESCE(s.next_billing_at, s.created_at) <= clock.as_of
+    ),
+    dates AS (
+        -- Every charge date from due_from up to the first one after now
+        SELECT d.id, d.user_id, d.name, d.amount, d.due_from,
+               d.anchor + n * d.step AS due_at
+        FROM due d
+        CROSS JOIN clock
+        CROSS JOIN LATERAL generate_series(
+            GREATEST(billing_cycles(d.anchor, d.due_from, d.cycle) - 1, 0),
+            billing_cycles(d.anchor, clock.as_of, d.cycle) + 1
+        ) AS n
+        WHERE d.anchor + n * d.step >= d.due_from
+    ),
+    inserted AS (
+        INSERT INTO expenses (user_id, item, amount, category, created_at, billing_key)
+        SELECT c.user_id, c.name, c.amount, 'Subscriptions', c.due_at,
+               'sub:' || c.id || ':' || to_char(c.due_at, 'YYYY-MM-DD')
+        FROM dates c, clock
+        WHERE c.due_at <= clock.as_of
+        ON CONFLICT (user_id, billing_key) DO NOTHING
+        RETURNING expenses.user_id, expenses.item, expenses.amount, expenses.created_at
+    ),
+    advanced AS (
+        UPDATE subscriptions s
+        SET next_billing_at = nxt.next_at
+        FROM (
+            SELECT id, MIN(due_at) AS next_at
+            FROM dates, clock
+            WHERE due_at > clock.as_of
+            GROUP BY id
+        ) nxt
+        WHERE s.id = nxt.id
+    )
+    SELECT * FROM inserted;
+$$;
+
+REVOKE EXECUTE ON FUNCTION materialize_subscription_charges(INTEGER)
+    FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION materialize_subscription_charges(INTEGER) TO service_role;
 
 -- ============================================
 -- INITIAL DATA
@@ -109,27 +337,53 @@ WHERE NOT EXISTS (SELECT 1 FROM income LIMIT 1);
 -- RLS POLICIES (Row Level Security)
 -- ============================================
 
+-- The bot acts for a user with a JWT it signs with the project's JWT
+-- secret (SUPABASE_JWT_SECRET); the user id is its user_id claim. Request
+-- headers are client-controlled and are not trusted: a request holding
+-- only the anon key has no user_id and matches no rows.
+CREATE OR REPLACE FUNCTION request_user_id() RETURNS BIGINT
+LANGUAGE sql STABLE AS $$
+    SELECT NULLIF(auth.jwt()->>'user_id', '')::BIGINT
+$$;
+
 -- Enable RLS on all tables
 ALTER TABLE financial_profile ENABLE ROW LEVEL SECURITY;
 ALTER TABLE chat_history ENABLE ROW LEVEL SECURITY;
+ALTER TABLE expenses ENABLE ROW LEVEL SECURITY;
 ALTER TABLE income ENABLE ROW LEVEL SECURITY;
 ALTER TABLE subscriptions ENABLE ROW LEVEL SECURITY;
 ALTER TABLE savings_goals ENABLE ROW LEVEL SECURITY;
 
--- Create policies allowing user_id = 1 access (single user app)
-CREATE POLICY "Allow access for user 1" ON financial_profile
-    FOR ALL USING (user_id = 1);
+-- Replace the old single-user policies
+DROP POLICY IF EXISTS "Allow access for user 1" ON financial_profile;
+DROP POLICY IF EXISTS "Allow access for user 1" ON chat_history;
+DROP POLICY IF EXISTS "Allow access for user 1" ON income;
+DROP POLICY IF EXISTS "Allow access for user 1" ON subscriptions;
+DROP POLICY IF EXISTS "Allow access for user 1" ON savings_goals;
+DROP POLICY IF EXISTS "Per-user access" ON financial_profile;
+DROP POLICY IF EXISTS "Per-user access" ON chat_history;
+DROP POLICY IF EXISTS "Per-user access" ON expenses;
+DROP POLICY IF EXISTS "Per-user access" ON income;
+DROP POLICY IF EXISTS "Per-user access" ON subscriptions;
+DROP POLICY IF EXISTS "Per-user access" ON savings_goals;
+
+-- Each request only sees and writes rows of the user it acts for
+CREATE POLICY "Per-user access" ON financial_profile
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
+
+CREATE POLICY "Per-user access" ON chat_history
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
 
-CREATE POLICY "Allow access for user 1" ON chat_history
-    FOR ALL USING (user_id = 1);
+CREATE POLICY "Per-user access" ON expenses
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
 
-CREATE POLICY "Allow access for user 1" ON income
-    FOR ALL USING (user_id = 1);
+CREATE POLICY "Per-user access" ON income
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
 
-CREATE POLICY "Allow access for user 1" ON subscriptions
-    FOR ALL USING (user_id = 1);
+CREATE POLICY "Per-user access" ON subscriptions
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
 
-CREATE POLICY "Allow access for user 1" ON savings_goals
-    FOR ALL USING (user_id = 1);
+CREATE POLICY "Per-user access" ON savings_goals
+    FOR ALL USING (user_id = request_user_id()) WITH CHECK (user_id = request_user_id());
 
 -- Done! Run this script in Supabase SQL Editor.
@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Configure an offline build before api/index.py reads its CONFIG block
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "contabil.db")
+for name in ("TELEGRAM_TOKEN", "SUPABASE_URL", "SUPABASE_KEY", "GROQ_API_KEY"):
+    os.environ[name] = ""
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import index  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The api/index.py module on a fresh SQLite file with empty caches"""
+    monkeypatch.setattr(index, "store", index.SQLiteStore(str(tmp_path / "t.db")))
+    monkeypatch.setattr(index.bot, "send_message", lambda *a, **k: None)
+    for cache in (
+        index._groq_breakers,
+        index._category_cache,
+        index._response_cache,
+        index._data_versions,
+        index._ledger_probes,
+        index._snapshots,
+        index._timeseries_cache,
+        index._subscriptions_cache,
+        index.budget_watcher._users,
+    ):
+        cache.clear()
+    return index
@@ -0,0 +1,47 @@
+import pytest
+
+
+@pytest.fixture
+def client(app):
+    client = app.app.test_client()
+    client.environ_base["HTTP_X_DASHBOARD_PASSWORD"] = app.DASHBOARD_PASSWORD
+    return client
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/timeseries?start=bad",
+        "/api/timeseries?granularity=week&end=2026-13-01",
+        "/api/export?start=bad",
+        "/api/export?table=income&format=ndjson&end=yesterday",
+    ],
+)
+def test_malformed_dates_are_rejected(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 400
+    assert "ISO date" in resp.get_json()["error"]
+
+
+def test_valid_dates_are_served(client):
+    resp = client.get("/api/timeseries?start=2026-01-01&end=2026-02-01T00:00:00")
+    assert resp.status_code == 200
+    assert resp.get_json() == {"granularity": "day", "series": []}
+    resp = client.get("/api/export?start=2026-01-01")
+    assert resp.status_code == 200
+
+
+@pytest.mark.parametrize("skip", ["abc", "-1", "1.5", ""])
+def test_malformed_import_skip_is_rejected(client, skip):
+    resp = client.post(f"/api/import?skip={skip}", data="Date,Description,Amount\n")
+    assert resp.status_code == 400
+    assert "skip" in resp.get_json()["error"]
+
+
+def test_import_with_skip(client, app):
+    body = "Date,Description,Amount\n2026-01-02,Coffee,3\n2026-01-03,Tea,2\n"
+    resp = client.post("/api/import?skip=1", data=body)
+    assert resp.status_code == 200
+    last = resp.get_data(as_text=True).splitlines()[-1]
+    assert '"done": true' in last
+    assert [r["item"] for r in app.store.scan_transactions("expenses", 1)] == ["Tea"]
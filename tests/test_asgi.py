@@ -0,0 +1,52 @@
+import asyncio
+import json
+
+
+def scope(path, query=b"", password="contabil123"):
+    return {
+        "type": "http",
+        "method": "POST",
+        "path": path,
+        "query_string": query,
+        "headers": [(b"x-dashboard-password", password.encode())],
+    }
+
+
+def run(app, scope, chunks):
+    """Serve one request; returns (events sent, receive() calls per send)"""
+    received, sent = [], []
+
+    async def receive():
+        await asyncio.sleep(0)
+        i = len(received)
+        received.append(i)
+        return {
+            "type": "http.request",
+            "body": chunks[i],
+            "more_body": i + 1 < len(chunks),
+        }
+
+    async def send(event):
+        sent.append((len(received), event))
+
+    asyncio.run(app.asgi_app(scope, receive, send))
+    return sent
+
+
+def test_import_body_is_streamed_to_flask(app, monkeypatch):
+    monkeypatch.setattr(app, "IMPORT_CHUNK_SIZE", 5)
+    lines = [b"Date,Description,Amount\n"] + [
+        f"2026-01-{d:02d},Coffee {d},3\n".encode() for d in range(1, 29)
+    ]
+    sent = run(app, scope("/api/import"), lines)
+    assert sent[0][1]["status"] == 200
+    bodies = [(n, e["body"]) for n, e in sent[1:] if e["body"]]
+    progress = [json.loads(line) for _, b in bodies for line in b.splitlines()]
+    assert progress[-1]["inserted"] == 28 and progress[-1]["done"]
+    # The first chunk was imported before the whole upload had been received
+    assert bodies[0][0] < len(lines)
+
+
+def test_unread_body_does_not_hang(app):
+    sent = run(app, scope("/api/import", password="wrong"), [b"x" * 100] * 50)
+    assert sent[0][1]["status"] == 401
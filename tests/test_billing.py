@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def add_sub(app, name="Netflix", cycle="monthly", created="2026-01-31T09:00:00+00:00"):
+    row = {
+        "user_id": 1,
+        "name": name,
+        "amount": 10,
+        "billing_cycle": cycle,
+        "is_active": 1,
+        "created_at": created,
+    }
+    assert app.store.insert_many("subscriptions", 1, [row])
+
+
+def charge_dates(app):
+    rows = app.store.scan_transactions("expenses", 1)
+    return [r["created_at"][:10] for r in rows]
+
+
+def test_month_end_anchor_does_not_drift(app):
+    add_sub(app)
+    for month in range(2, 7):
+        assert app.run_billing(utc(2026, month, 1, 12))["success"]
+    assert charge_dates(app) == [
+        "2026-01-31",
+        "2026-02-28",
+        "2026-03-31",
+        "2026-04-30",
+        "2026-05-31",
+    ]
+    sub = app.store.active_subscriptions(1)[0]
+    assert sub["next_billing_at"].startswith("2026-06-30")
+
+
+def test_billing_is_idempotent(app):
+    add_sub(app, "Gym", "weekly", "2026-10-01T09:00:00+00:00")
+    now = utc(2026, 10, 19, 12)
+    assert app.run_billing(now)["charged"] == 3
+    assert app.run_billing(now)["charged"] == 0
+    assert charge_dates(app) == ["2026-10-01", "2026-10-08", "2026-10-15"]
+
+
+def test_backfill_is_capped(app):
+    add_sub(app, "Cloud", "monthly", "2025-01-10T09:00:00+00:00")
+    app.run_billing(utc(2026, 10, 19, 12))
+    # Only charges within BILLING_MAX_BACKFILL_DAYS (31) are inserted
+    assert charge_dates(app) == ["2026-10-10"]
+    sub = app.store.active_subscriptions(1)[0]
+    assert sub["next_billing_at"].startswith("2026-11-10")
+
+
+def test_due_charges_from_drifted_cursor_returns_to_anchor_day(app):
+    sub = {
+        "created_at": "2026-01-31T09:00:00+00:00",
+        "next_billing_at": "2026-03-28T09:00:00+00:00",
+        "billing_cycle": "monthly",
+    }
+    due, next_at = app.due_charges(sub, utc(2026, 4, 30, 12))
+    assert [d.date().isoformat() for d in due] == ["2026-03-31", "2026-04-30"]
+    assert next_at.date().isoformat() == "2026-05-31"
+
+
+def test_supabase_billing_needs_service_key_and_sends_no_clock(app, monkeypatch):
+    calls = []
+
+    class Resp:
+        status_code = 200
+
+        def json(self):
+            return []
+
+    def fake(
+        endpoint, method="GET", json_body=None, params=None, user_id=None, key=None
+    ):
+        calls.append((endpoint, json_body, key))
+        return Resp()
+
+    monkeypatch.setattr(app, "supabase_request", fake)
+    supabase = app.SupabaseStore()
+    monkeypatch.setattr(app, "SUPABASE_SERVICE_KEY", "")
+    assert supabase.materialize_charges(utc(2030, 1, 1)) is None
+    assert calls == []
+    monkeypatch.setattr(app, "SUPABASE_SERVICE_KEY", "service")
+    assert supabase.materialize_charges(utc(2030, 1, 1)) == []
+    assert calls == [
+        ("rpc/materialize_subscription_charges", {"p_max_backfill_days": 31}, "service")
+    ]
+
+
+def test_subscription_cache_sees_other_instances_after_ttl(app, monkeypatch):
+    assert app.active_subscriptions_cached(1) == []
+    # Added by another instance: no local write, ledger counts unchanged
+    add_sub(app)
+    assert app.active_subscriptions_cached(1) == []
+    monkeypatch.setattr(app, "SUBSCRIPTIONS_CACHE_TTL", 0)
+    assert [s["name"] for s in app.active_subscriptions_cached(1)] == ["Netflix"]
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+def message(chat_type, chat_id=-100, user_id=7):
+    return SimpleNamespace(
+        chat=SimpleNamespace(id=chat_id, type=chat_type),
+        from_user=SimpleNamespace(id=user_id),
+        text="/dashboard",
+    )
+
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    out = []
+    monkeypatch.setattr(app, "DASHBOARD_SECRET", "s3cret")
+    monkeypatch.setattr(
+        app.bot, "send_message", lambda chat_id, text, **_: out.append((chat_id, text))
+    )
+    return out
+
+
+def test_dashboard_key_is_never_posted_to_a_group(app, sent):
+    app.send_dashboard_token(message("supergroup"))
+    assert len(sent) == 1
+    assert sent[0][0] == -100
+    assert app.dashboard_token(7) not in sent[0][1]
+
+
+def test_dashboard_key_in_private_chat(app, sent):
+    app.send_dashboard_token(message("private", chat_id=7))
+    assert sent == [(7, sent[0][1])]
+    assert app.dashboard_token(7) in sent[0][1]
@@ -0,0 +1,59 @@
+def test_drops_only_bookkeeping_keys(app):
+    compact, _ = app.compact_tool_result(
+        {
+            "subscriptions": [
+                {
+                    "id": 7,
+                    "user_id": 1,
+                    "billing_key": "7:2026-01-31",
+                    "name": "Gym",
+                    "amount": 39.999,
+                    "is_active": False,
+                    "score": 0.8,
+                    "created_at": "2026-01-31T10:00:00+00:00",
+                }
+            ]
+        }
+    )
+    assert compact["subscriptions"] == {
+        "columns": ["name", "amount", "is_active", "score", "date"],
+        "rows": [["Gym", 40.0, False, 0.8, "2026-01-31"]],
+    }
+
+
+def test_long_lists_keep_top_rows_and_stats(app, monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_TOP_N", 3)
+    rows = [
+        {
+            "id": i,
+            "item": f"item {i}",
+            "category": "Food" if i % 2 else "Fun",
+            "amount": float(i),
+        }
+        for i in range(1, 11)
+    ]
+    compact, text = app.compact_tool_result({"data": rows})
+    table = compact["data"]
+    assert table["rows"] == [
+        ["item 1", "Food", 1.0],
+        ["item 2", "Fun", 2.0],
+        ["item 3", "Food", 3.0],
+    ]
+    assert table["total_rows"] == 10
+    assert table["stats"]["amount"] == {"sum": 55, "min": 1.0, "max": 10.0, "avg": 5.5}
+    assert table["by_category"] == {"Food": 25.0, "Fun": 30.0}
+    assert app.estimate_tokens(text) <= app.TOOL_RESULT_MAX_TOKENS
+
+
+def test_time_series_keeps_latest_buckets(app, monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_TOP_N", 2)
+    series = [{"bucket": f"2026-01-0{d}", "net": d} for d in range(1, 6)]
+    compact, _ = app.compact_tool_result({"series": series})
+    assert compact["series"]["rows"] == [["2026-01-04", 4], ["2026-01-05", 5]]
+
+
+def test_oversized_result_is_truncated(app, monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_MAX_TOKENS", 50)
+    compact, text = app.compact_tool_result({"note": "x" * 5000})
+    assert compact["truncated"] is True
+    assert app.estimate_tokens(text) <= 50
@@ -0,0 +1,54 @@
+import csv
+import io
+
+import pytest
+
+USER = 1
+
+
+def seed(app):
+    stamps = ["2026-01-01T10:00:00+00:00"] * 4 + [
+        "2026-01-02T10:00:00+00:00",
+        "2026-01-03T10:00:00+00:00",
+        "2026-01-03T10:00:00+00:00",
+    ]
+    rows = [
+        {
+            "user_id": USER,
+            "item": f"item {i}",
+            "category": "Food",
+            "amount": i + 1,
+            "created_at": ts,
+        }
+        for i, ts in enumerate(stamps)
+    ]
+    # Inserted out of time order so ids and timestamps disagree
+    assert app.store.insert_many("expenses", USER, rows[::-1])
+    app.store.insert_expense(2, "someone else's", 9.0, "Food")
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 3, 7, 100])
+def test_keyset_pages_cover_every_row_once(app, page_size):
+    seed(app)
+    rows = list(app.iter_ledger(USER, "expenses", page_size=page_size))
+    assert sorted(r["item"] for r in rows) == [f"item {i}" for i in range(7)]
+    keys = [(r["created_at"], r["id"]) for r in rows]
+    assert keys == sorted(keys)
+
+
+def test_range_filters(app):
+    seed(app)
+    rows = list(
+        app.iter_ledger(USER, "expenses", "2026-01-02", "2026-01-02T23:59:59", 1)
+    )
+    assert [r["item"] for r in rows] == ["item 4"]
+
+
+def test_csv_export(app, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_PAGE_SIZE", 2)
+    seed(app)
+    text = "".join(app.export_lines(USER, "expenses"))
+    table = list(csv.reader(io.StringIO(text)))
+    assert table[0] == list(app.EXPORT_COLUMNS["expenses"])
+    assert len(table) == 8
+    assert sum(float(r[-1]) for r in table[1:]) == 28
@@ -0,0 +1,30 @@
+USER = 1
+
+
+def test_write_from_another_instance_reloads_the_snapshot(app, monkeypatch):
+    monkeypatch.setattr(app, "LEDGER_PROBE_TTL", 0)
+    app.store.insert_expense(USER, "Coffee", 3.0, "Food")
+    snap = app.get_snapshot(USER)
+    version = app.data_version(USER)
+    series = app.get_timeseries(USER, "month", "2000-01-01", "2100-01-01")
+    # Another process writes straight to the shared store
+    app.store.insert_income(USER, 100.0, "Salary")
+    assert app.data_version(USER) != version
+    assert app.get_snapshot(USER) is not snap
+    assert app.get_timeseries(USER, "month", "2000-01-01", "2100-01-01") != series
+
+
+def test_own_writes_keep_the_snapshot(app):
+    app.store.insert_expense(USER, "Coffee", 3.0, "Food")
+    snap = app.get_snapshot(USER)
+    app.tool_log_transaction("expense", 4, "Tea", "Food", user_id=USER)
+    assert app.get_snapshot(USER) is snap
+    assert snap.counts == [2, 0]
+
+
+def test_probe_is_reused_within_its_ttl(app):
+    app.data_version(USER)
+    probes = app.METRICS["freshness"]["probes"]
+    app.data_version(USER)
+    app.data_version(USER)
+    assert app.METRICS["freshness"]["probes"] == probes
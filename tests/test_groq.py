@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import pytest
+from groq import APIConnectionError, APIStatusError
+
+
+def status_error(code):
+    request = httpx.Request("POST", "https://api.groq.com/openai/v1/chat")
+    response = httpx.Response(code, request=request)
+    return APIStatusError(f"HTTP {code}", response=response, body=None)
+
+
+def run(app, create, model="m1", fallback="m1", deadline=5):
+    steps = app._groq_chat_steps([], model, fallback, deadline, {})
+    return app.drive(steps, {"create": create, "sleep": lambda delay: None})
+
+
+def trip(app, model):
+    app._breaker_record(model, False)
+    app._breaker(model).update(state="open", opened_at=0)
+
+
+def test_breaker_opens_after_threshold(app, monkeypatch):
+    monkeypatch.setattr(app, "GROQ_BREAKER_THRESHOLD", 2)
+    monkeypatch.setattr(app, "GROQ_MAX_RETRIES", 5)
+
+    def down(*_):
+        raise APIConnectionError(request=httpx.Request("POST", "https://x"))
+
+    with pytest.raises(app.GroqUnavailable):
+        run(app, down)
+    assert app._breaker("m1")["state"] == "open"
+    assert not app._breaker_allows("m1")
+
+
+def test_half_open_probe_success_closes(app):
+    trip(app, "m1")
+    assert run(app, lambda *_: "ok") == "ok"
+    assert app._breaker("m1") | {"opened_at": 0} == {
+        "state": "closed",
+        "failures": 0,
+        "opened_at": 0,
+    }
+
+
+def test_half_open_probe_failure_reopens(app, monkeypatch):
+    monkeypatch.setattr(app, "GROQ_MAX_RETRIES", 0)
+    trip(app, "m1")
+
+    def busy(*_):
+        raise status_error(503)
+
+    with pytest.raises(app.GroqUnavailable):
+        run(app, busy)
+    assert app._breaker("m1")["state"] == "open"
+    assert app._breaker("m1")["opened_at"] > 0
+
+
+def test_half_open_probe_rejected_request_settles(app):
+    trip(app, "m1")
+
+    def bad_request(*_):
+        raise status_error(400)
+
+    with pytest.raises(APIStatusError):
+        run(app, bad_request)
+    assert app._breaker("m1")["state"] == "closed"
+
+
+def test_cancelled_half_open_probe_frees_the_slot(app):
+    trip(app, "m1")
+
+    async def hang(*_):
+        await asyncio.sleep(60)
+
+    async def main():
+        steps = app._groq_chat_steps([], "m1", "m1", 5, {})
+        task = asyncio.ensure_future(app.drive_async(steps, {"create": hang}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert app._breaker("m1")["state"] == "open"
+    assert app._breaker_allows("m1")
+
+
+def test_fallback_shares_the_deadline(app, monkeypatch):
+    monkeypatch.setattr(app, "GROQ_MAX_RETRIES", 0)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    timeouts = []
+
+    def create(model, messages, timeout, kwargs):
+        timeouts.append((model, timeout))
+        now[0] += 3
+        if model == "m1":
+            raise status_error(503)
+        return "ok"
+
+    assert run(app, create, "m1", "m2", deadline=5) == "ok"
+    assert timeouts == [("m1", 5), ("m2", 2)]
@@ -0,0 +1,59 @@
+def rows(app, csv_text, **kwargs):
+    return list(app.iter_statement_rows(csv_text.splitlines(True), **kwargs))
+
+
+def test_credit_column_is_income_by_default(app):
+    out = rows(
+        app,
+        "Date,Description,Debit,Credit\n"
+        "2026-01-05,Coffee,4.50,\n"
+        "2026-01-31,Salary ACME,,2500.00\n",
+    )
+    assert [(r["type"], r["amount"], r["item"]) for r in out] == [
+        ("expense", 4.5, "Coffee"),
+        ("income", 2500.0, "Salary ACME"),
+    ]
+
+
+def test_signed_amount_column_respects_flag(app):
+    text = "Date,Description,Amount\n2026-01-05,Coffee,-4.50\n2026-01-31,Salary,2500\n"
+    assert [r["type"] for r in rows(app, text)] == ["expense", "expense"]
+    flagged = rows(app, text, positive_is_income=True)
+    assert [r["type"] for r in flagged] == ["expense", "income"]
+
+
+def test_import_inserts_into_both_tables(app):
+    text = "Date,Description,Debit,Credit\n2026-01-05,Coffee,4.50,\n2026-01-31,Salary,,2500\n"
+    *_, done = app.import_statement(1, text.splitlines(True))
+    assert done["inserted"] == 2 and "error" not in done
+    assert len(app.store.scan_transactions("expenses", 1)) == 1
+    assert app.store.scan_transactions("income", 1)[0]["source"] == "Salary"
+
+
+def test_repeated_lines_import_and_rerun_dedups_one_for_one(app):
+    text = (
+        "Date,Description,Amount\n"
+        "2026-01-05,Starbucks,-4.50\n"
+        "2026-01-05,Starbucks,-4.50\n"
+        "2026-01-06,Bus,-1.00\n"
+    ).splitlines(True)
+    *_, first = app.import_statement(1, text)
+    assert (first["inserted"], first["duplicates"]) == (3, 0)
+    *_, again = app.import_statement(1, text)
+    assert (again["inserted"], again["duplicates"]) == (0, 3)
+    # A third coffee that day is new
+    *_, more = app.import_statement(1, text[:2] + text[1:2] * 2)
+    assert (more["inserted"], more["duplicates"]) == (1, 2)
+
+
+def test_resume_skip_consumes_stored_matches(app):
+    text = (
+        "Date,Description,Amount\n"
+        "2026-01-05,Starbucks,-4.50\n"
+        "2026-01-05,Starbucks,-4.50\n"
+    ).splitlines(True)
+    *_, first = app.import_statement(1, text[:2])
+    assert first["inserted"] == 1
+    *_, resumed = app.import_statement(1, text, skip=1)
+    assert (resumed["inserted"], resumed["duplicates"]) == (1, 0)
+    assert len(app.store.scan_transactions("expenses", 1)) == 2
@@ -0,0 +1,62 @@
+import json
+from types import SimpleNamespace
+
+USER = 1
+
+
+def llm_stub(calls):
+    """Fake Groq: ask for tool_get_summary, then answer with text"""
+
+    def llm(messages, kwargs):
+        calls.append(messages)
+        if "tools" in kwargs:
+            call = SimpleNamespace(
+                id="c1",
+                function=SimpleNamespace(
+                    name="tool_get_summary",
+                    arguments=json.dumps({"period": "this_month"}),
+                ),
+            )
+            message = SimpleNamespace(content=None, tool_calls=[call])
+        else:
+            message = SimpleNamespace(content="Too much on food.", tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    return llm
+
+
+def ask(app, calls, text="how much on food this month?"):
+    return app.drive(
+        app._agent_steps(text, USER),
+        {
+            "store": lambda name, *args: getattr(app.store, name)(*args),
+            "llm": llm_stub(calls),
+            "tool": lambda func, kwargs: func(**kwargs),
+        },
+    )
+
+
+def test_repeated_question_is_a_hit(app):
+    calls = []
+    answers = [ask(app, calls) for _ in range(3)]
+    assert answers == ["Too much on food."] * 3
+    assert len(calls) == 2
+    stats = app.METRICS["response_cache"]
+    assert (stats["hits"], stats["stores"]) == (2, 1)
+
+
+def test_write_turns_a_hit_into_a_miss(app):
+    calls = []
+    ask(app, calls)
+    app.tool_log_transaction("expense", 30, "Pizza", "Food", user_id=USER)
+    ask(app, calls)
+    assert len(calls) == 4
+
+
+def test_write_from_another_instance_is_a_miss(app, monkeypatch):
+    monkeypatch.setattr(app, "LEDGER_PROBE_TTL", 0)
+    calls = []
+    ask(app, calls)
+    app.store.insert_expense(USER, "Pizza", 30.0, "Food")
+    ask(app, calls)
+    assert len(calls) == 4
@@ -0,0 +1,35 @@
+USER = 1
+
+
+def log(app, item, amount=5.0):
+    app.store.insert_expense(USER, item, amount, "Food")
+    app.snapshot_append(USER, app.EXPENSE, amount, "Food", item)
+
+
+def test_fuzzy_match_from_snapshot(app):
+    app.store.insert_expense(USER, "Starbucks", 4.0, "Food")
+    app.store.insert_expense(USER, "Uber Eats", 20.0, "Food")
+    app.get_snapshot(USER)
+    rows = app.search_transactions(USER, "starbux")
+    assert [r["item"] for r in rows] == ["Starbucks"]
+    assert [r["item"] for r in app.search_transactions(USER, "ubereats")] == [
+        "Uber Eats"
+    ]
+
+
+def test_index_only_reads_appended_rows(app, monkeypatch):
+    for item in ("Starbucks", "Lidl", "Kaufland"):
+        app.store.insert_expense(USER, item, 4.0, "Food")
+    snap = app.get_snapshot(USER)
+    app.search_transactions(USER, "lidl")
+    added = []
+    add = app.TrigramIndex.add
+    monkeypatch.setattr(
+        app.TrigramIndex,
+        "add",
+        lambda self, label: added.append(label) or add(self, label),
+    )
+    log(app, "Bolt Food")
+    assert [r["item"] for r in app.search_transactions(USER, "bolt")] == ["Bolt Food"]
+    assert added == ["Bolt Food"]
+    assert snap.search_index.indexed == snap.size == 4
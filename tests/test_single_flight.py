@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+FOLLOWERS = 4
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def run_concurrently(flight, fn):
+    """Start a leader and FOLLOWERS identical calls; returns their outcomes"""
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(("ok", flight.do("key", fn)))
+        except Exception as e:
+            outcomes.append(("error", e))
+
+    threads = [threading.Thread(target=call) for _ in range(FOLLOWERS + 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return outcomes
+
+
+@pytest.fixture
+def gated(app):
+    """An upstream call that blocks until every follower has joined it"""
+    flight = app.SingleFlight("test")
+    stats = app.METRICS["single_flight"]["test"]
+    calls = []
+
+    def upstream(result=None, error=None):
+        calls.append(1)
+        wait_for(lambda: stats["collapsed"] == FOLLOWERS)
+        if error:
+            raise error
+        return result
+
+    return flight, stats, calls, upstream
+
+
+def test_identical_calls_collapse_to_one(app, gated):
+    flight, stats, calls, upstream = gated
+    outcomes = run_concurrently(flight, lambda: upstream(result={"rows": 3}))
+    assert outcomes == [("ok", {"rows": 3})] * (FOLLOWERS + 1)
+    assert len(calls) == 1
+    assert (stats["calls"], stats["collapsed"]) == (1, FOLLOWERS)
+    # Nothing is cached once the call is done
+    assert flight.do("key", lambda: "again") == "again"
+
+
+def test_errors_reach_followers(app, gated):
+    flight, _, calls, upstream = gated
+    boom = RuntimeError("upstream down")
+    outcomes = run_concurrently(flight, lambda: upstream(error=boom))
+    assert outcomes == [("error", boom)] * (FOLLOWERS + 1)
+    assert len(calls) == 1
+
+
+def test_async_identical_calls_collapse_to_one(app):
+    flight = app.AsyncSingleFlight("test_async")
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("bad")
+
+    async def main():
+        ok = await asyncio.gather(*(flight.do("k", upstream) for _ in range(5)))
+        failed = await asyncio.gather(
+            *(flight.do("e", failing) for _ in range(5)), return_exceptions=True
+        )
+        return ok, failed
+
+    ok, failed = asyncio.run(main())
+    assert ok == ["ok"] * 5
+    assert all(isinstance(e, ValueError) for e in failed)
+    assert len(calls) == 2
+    assert app.METRICS["single_flight"]["test_async"] == {"calls": 2, "collapsed": 8}
@@ -0,0 +1,43 @@
+from datetime import datetime, timezone
+
+USER = 1
+
+
+def epoch(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+def test_in_order_append_keeps_row_indices(app):
+    app.store.insert_expense(USER, "Coffee", 3.0, "Food")
+    snap = app.get_snapshot(USER)
+    idx = snap.select()
+    app.store.insert_expense(USER, "Lunch", 9.0, "Food")
+    app.snapshot_append(USER, app.EXPENSE, 9.0, "Food", "Lunch")
+    assert app.get_snapshot(USER) is snap
+    assert snap.rows(idx)[0]["item"] == "Coffee"
+    assert snap.size == 2
+
+
+def test_backdated_append_drops_the_shared_snapshot(app):
+    app.store.insert_expense(USER, "Coffee", 3.0, "Food")
+    snap = app.get_snapshot(USER)
+    idx = snap.select()
+    app.store.insert_many(
+        "expenses",
+        USER,
+        [
+            {
+                "user_id": USER,
+                "item": "Rent",
+                "amount": 500.0,
+                "category": "Housing",
+                "created_at": "2020-01-01T00:00:00+00:00",
+            }
+        ],
+    )
+    app.snapshot_append(USER, app.EXPENSE, 500.0, "Housing", "Rent", epoch(2020, 1, 1))
+    # The old snapshot was left untouched for readers still holding it
+    assert snap.size == 1 and snap.rows(idx)[0]["item"] == "Coffee"
+    fresh = app.get_snapshot(USER)
+    assert fresh is not snap
+    assert [r["item"] for r in fresh.rows(fresh.select())] == ["Rent", "Coffee"]
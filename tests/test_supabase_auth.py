@@ -0,0 +1,36 @@
+import base64
+import hashlib
+import hmac
+import json
+
+
+def decode(part):
+    return json.loads(base64.urlsafe_b64decode(part + "=" * (-len(part) % 4)))
+
+
+def test_user_requests_carry_a_signed_user_jwt(app, monkeypatch):
+    monkeypatch.setattr(app, "SUPABASE_KEY", "anon")
+    monkeypatch.setattr(app, "SUPABASE_JWT_SECRET", "jwt-secret")
+    monkeypatch.setattr(app, "_user_jwts", {})
+    headers = app.supabase_headers(42)
+    assert headers["apikey"] == "anon"
+    assert not any(h.lower() == "x-user-id" for h in headers)
+    token = headers["Authorization"].removeprefix("Bearer ")
+    header, claims, signature = token.split(".")
+    assert decode(header) == {"alg": "HS256", "typ": "JWT"}
+    claims = decode(claims)
+    assert (claims["role"], claims["user_id"]) == ("authenticated", "42")
+    expected = hmac.new(
+        b"jwt-secret", f"{header}.{token.split('.')[1]}".encode(), hashlib.sha256
+    ).digest()
+    assert base64.urlsafe_b64encode(expected).rstrip(b"=").decode() == signature
+    assert app.supabase_headers(42) == headers
+
+
+def test_service_key_and_anonymous_requests_use_the_key(app, monkeypatch):
+    monkeypatch.setattr(app, "SUPABASE_KEY", "anon")
+    monkeypatch.setattr(app, "SUPABASE_JWT_SECRET", "jwt-secret")
+    assert app.supabase_headers()["Authorization"] == "Bearer anon"
+    assert app.supabase_headers(42, key="service")["Authorization"] == (
+        "Bearer service"
+    )
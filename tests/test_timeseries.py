@@ -0,0 +1,65 @@
+import pytest
+
+USER = 1
+
+
+def seed(app):
+    expenses = [
+        ("2025-12-29T23:30:00+00:00", "Coffee", "Food", 3.5),
+        ("2026-01-01T00:00:00+00:00", "Taxi", "Transport", 12.0),
+        ("2026-01-04T12:00:00+00:00", "Lunch", "Food", 80.25),
+        ("2026-01-05T08:00:00+00:00", "Lunch", "Food", 40.0),
+        ("2026-01-31T23:59:59+00:00", "Cinema", "Fun", 15.0),
+        ("2026-02-01T00:00:01+00:00", "Bus", "Transport", 2.0),
+        ("2026-03-15T09:00:00+00:00", "Rent", "Housing", 500.0),
+    ]
+    income = [
+        ("2026-01-05T09:00:00+00:00", "Salary", 1000.0),
+        ("2026-02-01T00:00:00+00:00", "Gift", 50.0),
+    ]
+    assert app.store.insert_many(
+        "expenses",
+        USER,
+        [
+            {"user_id": USER, "item": i, "category": c, "amount": a, "created_at": t}
+            for t, i, c, a in expenses
+        ],
+    )
+    assert app.store.insert_many(
+        "income",
+        USER,
+        [
+            {"user_id": USER, "source": s, "amount": a, "created_at": t}
+            for t, s, a in income
+        ],
+    )
+
+
+@pytest.mark.parametrize("granularity", ["day", "week", "month"])
+@pytest.mark.parametrize("by_category", [False, True])
+@pytest.mark.parametrize(
+    "start,end",
+    [("2025-12-01", "2026-04-01"), ("2026-01-01", "2026-02-01")],
+)
+def test_snapshot_matches_store(app, granularity, by_category, start, end):
+    seed(app)
+    from_store = app._timeseries_from_store(USER, start, end, granularity, by_category)
+    snap = app.get_snapshot(USER)
+    assert snap.series(start, end, granularity, by_category) == from_store
+
+
+def test_served_from_snapshot_when_warm(app):
+    seed(app)
+    cold = app.get_timeseries(USER, "week", "2025-12-01", "2026-04-01")
+    app._timeseries_cache.clear()
+    app.get_snapshot(USER)
+    served = app.METRICS["timeseries"]["from_snapshot"]
+    warm = app.get_timeseries(USER, "week", "2025-12-01", "2026-04-01")
+    assert app.METRICS["timeseries"]["from_snapshot"] == served + 1
+    assert warm == cold
+    assert [b["bucket"] for b in warm] == [
+        "2025-12-29",
+        "2026-01-05",
+        "2026-01-26",
+        "2026-03-09",
+    ]
@@ -0,0 +1,77 @@
+import pytest
+
+USER = 1
+
+
+@pytest.fixture
+def sent(app, monkeypatch):
+    messages = []
+    monkeypatch.setattr(app.bot, "send_message", lambda _, text: messages.append(text))
+    app.store._insert("financial_profile", [{"user_id": USER, "budget": 100}])
+    return messages
+
+
+def spend(app, amount, item="Coffee", category="Food"):
+    app.tool_log_transaction("expense", amount, item, category, user_id=USER)
+
+
+def test_budget_alert_fires_once_per_threshold(app, sent):
+    spend(app, 50)
+    spend(app, 40)
+    spend(app, 5)
+    spend(app, 20)
+    spend(app, 1)
+    assert [m.split(" MDL")[0] for m in sent] == [
+        "Budget alert: 90.00 of 100.00",
+        "Budget alert: 115.00 of 100.00",
+    ]
+
+
+@pytest.mark.parametrize("reset", [False, True])
+def test_cold_seed_alerts_on_the_crossing_expense(app, sent, reset):
+    app.store.insert_expense(USER, "Rent", 90.0, "Housing")
+    if reset:
+        spend(app, 1)
+        app.budget_watcher.reset(USER)
+        sent.clear()
+    spend(app, 20)
+    assert len(sent) == 1 and sent[0].startswith("Budget alert")
+
+
+def test_anomaly_against_seeded_stats(app, sent, monkeypatch):
+    monkeypatch.setattr(app, "BUDGET_ALERT_THRESHOLDS", [])
+    for amount in (10, 11, 9, 10, 12, 10):
+        app.store.insert_expense(USER, "Coffee", float(amount), "Food")
+    spend(app, 10)
+    assert sent == []
+    spend(app, 60)
+    assert len(sent) == 1 and sent[0].startswith("Unusual expense: 60.00 MDL")
+
+
+def test_workers_share_threshold_alerts(app, sent, monkeypatch):
+    monkeypatch.setattr(app, "LEDGER_PROBE_TTL", 0)
+    worker_a, worker_b = app.budget_watcher, app.BudgetWatcher()
+
+    def spend_on(watcher, amount):
+        app.store.insert_expense(USER, "Coffee", float(amount), "Food")
+        app.snapshot_append(USER, app.EXPENSE, float(amount), "Food", "Coffee")
+        app.send_alerts(USER, watcher.observe(USER, float(amount), "Food"))
+
+    spend_on(worker_a, 50)
+    spend_on(worker_b, 40)
+    # Worker A has not seen B's 40: it re-seeds and knows 80% already fired
+    spend_on(worker_a, 5)
+    spend_on(worker_a, 10)
+    assert [m.split(" MDL")[0] for m in sent] == [
+        "Budget alert: 90.00 of 100.00",
+        "Budget alert: 105.00 of 100.00",
+    ]
+    assert app.METRICS["watcher"]["reseeds"] >= 1
+
+
+def test_expense_from_another_worker_counts_toward_the_budget(app, sent, monkeypatch):
+    monkeypatch.setattr(app, "LEDGER_PROBE_TTL", 0)
+    spend(app, 50)
+    app.store.insert_expense(USER, "Rent", 25.0, "Housing")
+    spend(app, 10)
+    assert [m.split(" MDL")[0] for m in sent] == ["Budget alert: 85.00 of 100.00"]
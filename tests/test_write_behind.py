@@ -0,0 +1,84 @@
+import pytest
+
+
+@pytest.fixture
+def buffer(app, monkeypatch):
+    stats = {"queued": 0, "flushed": 0, "batches": 0, "failures": 0, "dropped": 0}
+    buf = app.WriteBehindBuffer("chat_history", stats)
+    # Flushes are driven by the test, not the background thread
+    monkeypatch.setattr(buf, "_ensure_thread", lambda: None)
+    return buf
+
+
+@pytest.fixture
+def inserts(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        app.store,
+        "insert_many",
+        lambda table, user_id, rows: calls.append((table, user_id, list(rows))) or True,
+    )
+    return calls
+
+
+def row(user_id, content):
+    return {"user_id": user_id, "role": "user", "content": content}
+
+
+def test_rows_are_batched_into_one_insert_per_user(buffer, inserts):
+    for i in range(3):
+        buffer.add(row(1, f"a{i}"))
+    buffer.add(row(2, "b0"))
+    assert inserts == [] and buffer.backlog() == 4
+    assert [r["content"] for r in buffer.pending(1)] == ["a0", "a1", "a2"]
+    assert buffer.flush()
+    assert [(t, u, len(rows)) for t, u, rows in inserts] == [
+        ("chat_history", 1, 3),
+        ("chat_history", 2, 1),
+    ]
+    assert buffer.backlog() == 0
+    assert (buffer.stats["flushed"], buffer.stats["batches"]) == (4, 2)
+
+
+def test_full_batch_wakes_the_flusher(app, buffer, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_BATCH_SIZE", 2)
+    buffer.add(row(1, "a"))
+    assert not buffer._wakeup.is_set()
+    buffer.add(row(1, "b"))
+    assert buffer._wakeup.is_set()
+
+
+def test_backlog_is_bounded(app, buffer, inserts, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_BACKLOG", 3)
+    for i in range(5):
+        buffer.add(row(1, str(i)))
+    assert [r["content"] for r in buffer.pending(1)] == ["2", "3", "4"]
+    assert buffer.stats["dropped"] == 2
+    assert buffer.stats["queued"] == 5
+
+
+def test_failed_rows_are_requeued_in_front(app, buffer, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_MAX_BACKLOG", 3)
+    down = []
+    monkeypatch.setattr(
+        app.store,
+        "insert_many",
+        lambda table, user_id, rows: down.append(rows) and False,
+    )
+    buffer.add(row(1, "a"))
+    buffer.add(row(1, "b"))
+    assert not buffer.flush()
+    assert buffer.stats["failures"] == 1
+    buffer.add(row(1, "c"))
+    buffer.add(row(1, "d"))
+    # Requeued rows go first; the oldest one is dropped to honour the bound
+    assert [r["content"] for r in buffer.pending(1)] == ["b", "c", "d"]
+    assert buffer.stats["dropped"] == 1
+    saved = []
+    monkeypatch.setattr(
+        app.store,
+        "insert_many",
+        lambda table, user_id, rows: saved.extend(rows) or True,
+    )
+    assert buffer.flush()
+    assert [r["content"] for r in saved] == ["b", "c", "d"]